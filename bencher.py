@@ -3,16 +3,28 @@ import threading
 from threading import Thread
 import multiprocessing
 from multiprocessing import Process
+from multiprocessing import shared_memory
+from multiprocessing.reduction import ForkingPickler
 import time
+import os
 import requests
 import logging
 logging.basicConfig(level=logging.WARNING, format='[%(process)s] [%(threadName)s] [%(filename)s:%(lineno)s] [%(levelname)s] %(message)s')
 import queue
 import string
 import random
+import struct
 import faulthandler
 import signal
 import code, traceback, signal
+from histogram import Histogram
+from httpserver import Server
+from stats import confidence_interval
+from resultstore import ResultStore, usage
+
+# Set BENCHER_RESULTS to append a JSONL record for every benchmark, and
+# BENCHER_RUN to name the run (defaults to a timestamp).
+STORE = ResultStore(os.environ['BENCHER_RESULTS'], os.getenv('BENCHER_RUN')) if os.getenv('BENCHER_RESULTS') else None
 
 # http://stackoverflow.com/a/133384
 def debug(sig, frame):
@@ -64,33 +76,67 @@ class ThreadPool:
 
         self.filter_workers(workers, block=True)
         logging.debug('Terminating master.')
+        self.results_queue.put(None)
 
     def run(self, target, *args):
+        self.call(target, *args)
+
+        self.workers.release()
+        logging.debug('Released worker.')
+
+    def call(self, target, *args):
         logging.debug('Launching %s with %s' % (target, args))
 
+        start_time = time.perf_counter_ns()
+
         try:
-            self.results_queue.put({ "result": target(*args) })
+            result = target(*args)
+            self.results_queue.put({ "result": result, "latency": time.perf_counter_ns() - start_time })
             logging.debug('Worker successful.')
         except Exception as e:
             logging.debug('Got error %s' % e)
-            self.results_queue.put({ "error": e })
-
-        self.workers.release()
-        logging.debug('Released worker.')
+            self.results_queue.put({ "error": e, "latency": time.perf_counter_ns() - start_time })
 
     def filter_workers(self, workers, block=False):
         logging.debug('Filtering living workers.')
         return list(filter(lambda w: w.join(block or 0) or w.is_alive(), workers))
 
+    def producers(self):
+        """
+        The threads or processes that put a STOP on the results queue when
+        they exit.
+        """
+        return [self.__master]
+
     def results(self):
-        while self.__master.is_alive():
+        """
+        Yield results until every producer has put its STOP. A process that
+        dies without one is noticed when the queue goes quiet.
+        """
+        producers = self.producers()
+        remaining = len(producers)
+        dead = set()
+
+        while remaining:
             logging.debug('Fetching from result queue.')
-
             try:
-                yield self.results_queue.get(block=False)
+                result = self.results_queue.get(timeout=1)
             except queue.Empty:
-                logging.debug('Queue empty.')
-                time.sleep(1)
+                for index, producer in enumerate(producers):
+                    # Threads have no exit code, and a clean exit's STOP is
+                    # still on its way.
+                    exitcode = getattr(producer, 'exitcode', None)
+                    if exitcode and index not in dead:
+                        logging.error('%s died with exit code %d.' % (producer.name, exitcode))
+                        dead.add(index)
+                        remaining -= 1
+                continue
+
+            if result is None:
+                remaining -= 1
+                continue
+
+            yield result
 
         logging.debug('Workers and master exited and queue is empty, exiting.')
 
@@ -102,6 +148,73 @@ class ThreadPool:
         logging.debug('Sending STOP signal to master.')
         self.work_queue.put(None)
 
+class PersistentThreadPool(ThreadPool):
+    """
+    Thread pool with a fixed set of long-lived workers that pull batches of
+    work directly from the work queue, instead of starting a thread per task.
+    """
+    def __init__(self, workers=10, batch_size=100):
+        logging.info('Creating persistent thread pool with %d workers.' % workers)
+        self.work_queue = queue.Queue()
+        self.results_queue = queue.Queue()
+        self.num_workers = workers
+        self.batch_size = batch_size
+        self.batch = []
+        self.thread_class = threading.Thread
+        self.start()
+
+    def start(self):
+        self.threads = []
+
+        for _ in range(self.num_workers):
+            thread = self.thread_class(target=self.worker)
+            thread.start()
+            self.threads.append(thread)
+
+    def worker(self):
+        while True:
+            batch = self.work_queue.get()
+            if batch is None:
+                logging.debug('STOP received, exiting worker.')
+                break
+
+            for work in batch:
+                self.call(*work)
+
+        self.results_queue.put(None)
+
+    def producers(self):
+        return self.threads
+
+    def add_work(self, func, *args):
+        self.batch.append((func,) + args)
+
+        # Hold work back until every worker can have a full batch, so a
+        # short run isn't cut into fewer batches than there are workers.
+        if len(self.batch) >= self.batch_size * self.num_workers:
+            self.flush()
+
+    def flush(self):
+        """
+        Queue the held back work split evenly over the workers, at most
+        batch_size tasks to a batch.
+        """
+        if not self.batch:
+            return
+
+        size = min(self.batch_size, -(-len(self.batch) // self.num_workers))
+        for start in range(0, len(self.batch), size):
+            self.work_queue.put(self.batch[start:start + size])
+
+        self.batch = []
+
+    def close(self):
+        logging.debug('Sending STOP signal to workers.')
+        self.flush()
+
+        for _ in self.threads:
+            self.work_queue.put(None)
+
 class ProcessPool(ThreadPool):
     def __init__(self, workers=10):
         logging.info('Creating process pool with %d workers.' % workers)
@@ -111,81 +224,379 @@ class ProcessPool(ThreadPool):
         self.thread_class = multiprocessing.Process
         self.start()
 
+class PersistentProcessPool(PersistentThreadPool):
+    """
+    Process pool with a fixed set of long-lived worker processes.
+
+    Work is shipped to the workers in pickled batches of batch_size tasks.
+    Each worker owns a ring of slots in a shared memory block that it writes
+    (latency, result) pairs into, and only sends a small notification per
+    batch back to the parent. Float results and ints that fit in 64 bits
+    come back through the ring, tagged with their type; any other result,
+    and errors, ride along with the notification. Each worker may have at
+    most `inflight` batches that the parent has not consumed yet, so the
+    ring is never overwritten.
+    """
+    # latency, kind, int value, float value
+    SLOT = struct.Struct('qBqd')
+    FLOAT, INT = 0, 1
+
+    def __init__(self, workers=10, batch_size=100, inflight=4):
+        logging.info('Creating persistent process pool with %d workers.' % workers)
+        self.work_queue = multiprocessing.Queue()
+        self.results_queue = multiprocessing.Queue()
+        self.num_workers = workers
+        self.batch_size = batch_size
+        self.batch = []
+        self.capacity = batch_size * inflight
+        self.slots = [multiprocessing.Semaphore(inflight) for _ in range(workers)]
+        self.memory = shared_memory.SharedMemory(create=True, size=workers * self.capacity * self.SLOT.size)
+        self.thread_class = multiprocessing.Process
+        self.start()
+
+    def start(self):
+        self.threads = []
+
+        for index in range(self.num_workers):
+            process = self.thread_class(target=self.worker, args=(index,))
+            process.start()
+            self.threads.append(process)
+
+    def worker(self, index):
+        offset = index * self.capacity
+        position = 0
+
+        while True:
+            batch = self.work_queue.get()
+            if batch is None:
+                logging.debug('STOP received, exiting worker.')
+                break
+
+            self.slots[index].acquire()
+            extras = {}
+
+            for i, (target, *args) in enumerate(batch):
+                kind, integer, number = self.FLOAT, 0, 0.0
+                start_time = time.perf_counter_ns()
+
+                try:
+                    result = target(*args)
+                    latency = time.perf_counter_ns() - start_time
+
+                    if type(result) is float:
+                        number = result
+                    elif type(result) is int and -2**63 <= result < 2**63:
+                        kind, integer = self.INT, result
+                    else:
+                        extras[i] = { "result": result }
+                except Exception as e:
+                    latency = time.perf_counter_ns() - start_time
+                    extras[i] = { "error": e }
+
+                slot = offset + (position + i) % self.capacity
+                self.SLOT.pack_into(self.memory.buf, slot * self.SLOT.size, latency, kind, integer, number)
+
+            # The queue's feeder thread drops a message that doesn't pickle,
+            # which would leave the parent reading later batches from the
+            # wrong slots.
+            if extras and not picklable(extras):
+                for i, extra in extras.items():
+                    if not picklable(extra):
+                        kind = "result" if "result" in extra else "error"
+                        extras[i] = { "error": TypeError('%s of type %s can\'t be pickled' % (kind, type(extra[kind]).__name__)) }
+
+            position += len(batch)
+            self.results_queue.put((index, len(batch), extras))
+
+        self.results_queue.put((index, None, None))
+
+    def results(self):
+        """
+        Yield results until every worker has stopped. A worker that dies
+        without saying so is noticed when the queue goes quiet, and its
+        unreported results are lost.
+        """
+        running = set(range(self.num_workers))
+        positions = [0] * self.num_workers
+
+        try:
+            while running:
+                try:
+                    message = self.results_queue.get(timeout=1)
+                except queue.Empty:
+                    for index in list(running):
+                        exitcode = self.threads[index].exitcode
+                        # A clean exit's STOP is still on its way.
+                        if exitcode is not None and exitcode != 0:
+                            logging.error('Worker %d died with exit code %d.' % (index, exitcode))
+                            running.discard(index)
+                    continue
+
+                index, count, extras = message
+                if count is None:
+                    running.discard(index)
+                    continue
+
+                for i in range(count):
+                    slot = index * self.capacity + (positions[index] + i) % self.capacity
+                    latency, kind, integer, number = self.SLOT.unpack_from(self.memory.buf, slot * self.SLOT.size)
+
+                    result = extras.get(i) or { "result": integer if kind == self.INT else number }
+                    result["latency"] = latency
+                    yield result
+
+                positions[index] += count
+                self.slots[index].release()
+
+            for process in self.threads:
+                process.join()
+        finally:
+            self.memory.close()
+            self.memory.unlink()
+
+        logging.debug('Workers exited and queue is empty, exiting.')
+
 def runner(func, times, *args):
     logging.info('entering runner')
 
+    histogram = Histogram()
+
     for _ in range(times):
+        start_time = time.perf_counter_ns()
+
         try:
             func(*args)
         except Exception as e:
             logging.error('Error in thread: %s' % e)
 
-    logging.info('leaving runner')
-
-def bench(func, times, workers, bench_type, *args):
-    logging.warning('%s:' % bench_type)
+        histogram.record(time.perf_counter_ns() - start_time)
 
+    logging.info('leaving runner')
+    return histogram
+
+def collect(results, func, times, *args):
+    results.put(runner(*((func, times,) + args)))
+
+def report(histogram, elapsed):
+    summary = histogram.summary()
+
+    logging.warning('Completed %d calls in %.3f seconds, %.2f calls/s.' % (summary['count'], elapsed, summary['count'] / elapsed))
+    logging.warning('Latency (us): p50=%.1f p90=%.1f p99=%.1f p99.9=%.1f max=%.1f' % tuple(
+        summary[key] / 1000.0 for key in ('p50', 'p90', 'p99', 'p99.9', 'max')))
+
+def save(kind, func, mode, workers, times, histogram, elapsed, start_usage, rates=None, trial_latency=None):
+    if not STORE:
+        return
+
+    cpu_time, max_rss = usage()
+
+    STORE.append({
+        'bench': kind,
+        'function': func.__name__,
+        'mode': mode,
+        'workers': workers,
+        'iterations': times,
+        'elapsed': elapsed,
+        'throughput': histogram.count / elapsed,
+        'rates': rates,
+        'trial_latency': trial_latency,
+        'histogram': histogram.to_dict(),
+        'latency': histogram.summary(),
+        'cpu_time': cpu_time - start_usage[0],
+        'max_rss_kb': max_rss,
+    })
+
+def trial(func, times, workers, bench_type, *args):
     threads = []
-    each = int(times / workers)
+    histogram = Histogram()
 
     thread_type = Thread
+    results = queue.Queue()
     if bench_type == 'multiprocessing':
         thread_type = Process
+        results = multiprocessing.Queue()
 
-    start_time = time.time()
+    start_time = time.perf_counter()
+
+    for index in range(workers):
+        # Spread the remainder over the first workers so no calls are dropped.
+        each = times // workers + (1 if index < times % workers else 0)
 
-    for _ in range(workers):
         if bench_type == 'single threaded':
-            runner(*((func, each,) + args))
+            histogram.merge(runner(*((func, each,) + args)))
         else:
-            t = thread_type(target=runner, args=(func, each,) + args)
+            t = thread_type(target=collect, args=(results, func, each,) + args)
             t.start()
             threads.append(t)
 
     if bench_type != 'single threaded':
+        # Drain the results before joining so processes don't block flushing
+        # their queue.
+        for _ in threads:
+            histogram.merge(results.get())
+
         for thread in threads:
             thread.join()
 
-    logging.warning('Completed in %d seconds.' % (time.time() - start_time))
+    return histogram, time.perf_counter() - start_time
+
+def repeat(run, times, min_trials, max_trials, precision=0):
+    """
+    Call run(), which returns the histogram and elapsed time of a trial of
+    times calls, min_trials times and then until the 95% confidence interval
+    of calls/s is within precision of the mean (or max_trials is hit).
+
+    Return the merged histogram, the total time, the calls/s of each trial
+    and its mean and p99 latency, so runs can be compared trial against
+    trial rather than call against call.
+    """
+    histogram = Histogram()
+    rates = []
+    trial_latency = []
+    total_time = 0
+
+    while len(rates) < max_trials:
+        trial_histogram, elapsed = run()
+        histogram.merge(trial_histogram)
+        total_time += elapsed
+        rates.append(times / elapsed)
+        trial_latency.append({'mean': trial_histogram.mean(), 'p99': trial_histogram.percentile(99)})
+
+        mean, error = confidence_interval(rates)
+        if len(rates) >= min_trials and error <= mean * precision:
+            break
+
+    return histogram, total_time, rates, trial_latency
+
+def report_rates(rates, times):
+    mean, error = confidence_interval(rates)
+    logging.warning('Throughput: %.2f +/- %.2f calls/s (95%% CI, %d trials of %d calls).' % (mean, error, len(rates), times))
+    return mean, error
+
+def bench(func, times, workers, bench_type, *args, trials=3):
+    logging.warning('%s:' % bench_type)
+
+    start_usage = usage()
+    histogram, elapsed, rates, trial_latency = repeat(
+        lambda: trial(*((func, times, workers, bench_type) + args)), times, trials, trials)
+
+    report(histogram, elapsed)
+    report_rates(rates, times)
+    save('bench', func, bench_type, workers, times, histogram, elapsed, start_usage, rates, trial_latency)
 
-def multibench(func, times, workers, *args):
+def multibench(func, times, workers, *args, **kwargs):
     logging.warning('Running %s %d times with %d workers.' % (func, times, workers))
-    bench(func, times, workers, 'multiprocessing', *args)
-    bench(func, times, workers, 'threading', *args)
-    bench(func, times, workers, 'single threaded', *args)
+    bench(func, times, workers, 'multiprocessing', *args, **kwargs)
+    bench(func, times, workers, 'threading', *args, **kwargs)
+    bench(func, times, workers, 'single threaded', *args, **kwargs)
+
+def calibrate(func, workers, bench_type, target_time, *args):
+    """
+    Find the number of calls that takes roughly target_time seconds by
+    doubling the count until a trial is long enough to extrapolate from.
+    """
+    times = workers
+
+    while True:
+        _, elapsed = trial(*((func, times, workers, bench_type) + args))
+
+        if elapsed >= target_time / 10:
+            return max(int(times * target_time / elapsed), workers)
+
+        times *= 2
+
+def autobench(func, workers, bench_type, *args, target_time=1.0, warmup=1,
+              min_trials=3, max_trials=30, precision=0.02):
+    """
+    Benchmark func with a calibrated call count: discard warmup trials, then
+    repeat trials until the 95% confidence interval of calls/s is within
+    precision of the mean (or max_trials is hit).
+    """
+    logging.warning('%s:' % bench_type)
 
-def poolbench(func, pool_type, times, workers, *args):
-    logging.warning('Running with pool type: %s' % pool_type)
+    times = calibrate(*((func, workers, bench_type, target_time) + args))
+    logging.info('Calibrated to %d calls per trial.' % times)
+
+    for _ in range(warmup):
+        trial(*((func, times, workers, bench_type) + args))
+
+    start_usage = usage()
+    histogram, total_time, rates, trial_latency = repeat(
+        lambda: trial(*((func, times, workers, bench_type) + args)), times, min_trials, max_trials, precision)
+
+    report(histogram, total_time)
+    save('autobench', func, bench_type, workers, times, histogram, total_time, start_usage, rates, trial_latency)
+
+    return report_rates(rates, times)
 
-    start_time = time.time()
+def multiautobench(func, workers, *args, **kwargs):
+    logging.warning('Running %s with %d workers, calibrated.' % (func, workers))
+    autobench(func, workers, 'multiprocessing', *args, **kwargs)
+    autobench(func, workers, 'threading', *args, **kwargs)
+    autobench(func, workers, 'single threaded', *args, **kwargs)
+
+def pool_trial(func, pool_type, times, workers, *args):
+    histogram = Histogram()
+    start_time = time.perf_counter()
 
     if pool_type:
         pool = pool_type(workers)
 
         for _ in range(times):
-            pool.add_work(count_to_1000)
+            pool.add_work(func, *args)
 
         pool.close()
 
         for result in pool.results():
             logging.info(result)
+            histogram.record(result['latency'])
     else:
-        logging.info(runner(func, times, *args))
+        histogram = runner(func, times, *args)
+
+    return histogram, time.perf_counter() - start_time
+
+def poolbench(func, pool_type, times, workers, *args, trials=3):
+    logging.warning('Running with pool type: %s' % pool_type)
+
+    start_usage = usage()
+    histogram, elapsed, rates, trial_latency = repeat(
+        lambda: pool_trial(*((func, pool_type, times, workers) + args)), times, trials, trials)
+
+    report(histogram, elapsed)
+    report_rates(rates, times)
+    save('poolbench', func, pool_type.__name__ if pool_type else 'no pool', workers, times, histogram, elapsed, start_usage,
+        rates, trial_latency)
+
+def picklable(args):
+    """
+    Whether args can be sent through a multiprocessing queue. Locks and
+    other synchronization primitives can only be inherited, not sent.
+    """
+    try:
+        ForkingPickler.dumps(args)
+    except Exception:
+        return False
 
-    logging.warning('Completed in %d seconds.' % (time.time() - start_time))
+    return True
 
-def multipoolbench(func, times, workers, *args):
+def multipoolbench(func, times, workers, *args, **kwargs):
     logging.warning('Running %s %d times with %d workers.' % (func, times, workers))
-    poolbench(func, ProcessPool, times, workers, *args)
-    poolbench(func, ThreadPool, times, workers, *args)
-    poolbench(func, None, times, workers, *args)
+
+    for pool_type in (ProcessPool, ThreadPool, PersistentThreadPool, PersistentProcessPool, None):
+        # The process pools ship work through a queue, so they can't run
+        # functions taking a lock.
+        if pool_type in (ProcessPool, PersistentProcessPool) and not picklable(args):
+            logging.warning('Skipping %s, the arguments of %s can\'t be pickled.' % (pool_type.__name__, func.__name__))
+            continue
+
+        poolbench(func, pool_type, times, workers, *args, **kwargs)
 
 def acquire_mutex(lock):
     lock.acquire()
     lock.release()
 
-def get_page():
-    requests.get('http://127.0.0.1').content
+def get_page(url='http://127.0.0.1'):
+    requests.get(url).content
 
 def read_1000000_bytes():
     open('/dev/urandom', 'rb').read(1000000)
@@ -221,7 +632,11 @@ if __name__ == '__main__':
 
     multipoolbench(read_1000000_bytes, 4000, 100)
     multipoolbench(count_to_1000, 100000, 100)
-    multipoolbench(get_page, 4000, 100)
+    # get_page() hits a local stand-in server unless BENCHER_URL is set.
+    server = None if os.getenv('BENCHER_URL') else Server(processes=multiprocessing.cpu_count()).start()
+    url = os.getenv('BENCHER_URL') or server.url
+
+    multipoolbench(get_page, 4000, 100, url)
 
     q = multiprocessing.Queue()
     multibench(do_queue, 500000, 100, q)
@@ -230,4 +645,7 @@ if __name__ == '__main__':
     multibench(acquire_mutex, 5000000, 100, lock)
 
     multibench(count_to_1000, 100000, 100)
-    multibench(get_page, 4000, 100)
+    multibench(get_page, 4000, 100, url)
+
+    if server:
+        server.stop()
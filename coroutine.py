@@ -1,31 +1,315 @@
 import types
+import collections
+import errno
+import heapq
+import itertools
+import os
+import fcntl
+import weakref
+import multiprocessing
 import uuid
 import socket
 import select
 import time
-import Queue
-import signal
+import sys
+import threading
+import traceback
 import logging
+from functools import reduce
+try:
+    import Queue as queue
+except ImportError:
+    import queue
 #logging.basicConfig(level=logging.DEBUG)
-#import traceback
+
+PY2 = sys.version_info[0] == 2
+
+# time.monotonic only exists on Python 3.
+clock = getattr(time, 'monotonic', time.time)
+# Process CPU time, time.clock measures it on Python 2.
+cpu_clock = getattr(time, 'process_time', None) or time.clock
+# Python 2 doesn't export SO_REUSEPORT, 15 is its value on Linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
 
 class States:
     READABLE = select.EPOLLIN
     WRITABLE = select.EPOLLOUT
 
-class ScheduleTask:
+# The scheduler dispatches on the exact type of whatever a coroutine yields,
+# so these are new-style classes on Python 2 as well.
+class ScheduleTask(object):
     def __init__(self, coroutine):
         self.coroutine = coroutine
 
+# Sleep, Wait and Event can also be awaited from async def coroutines, their
+# __await__ yields the same request a generator coroutine would.
+class Sleep(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __await__(self):
+        yield self
+
+class Wait(object):
+    """
+    Await until sock is ready for mask, raising Timeout after timeout seconds.
+    """
+    def __init__(self, sock, mask, timeout=None):
+        self.sock = sock
+        self.mask = mask
+        self.timeout = timeout
+
+    def __await__(self):
+        yield self
+
+class Event(object):
+    """
+    A flag coroutines can wait on until another coroutine on the same
+    scheduler sets it.
+    """
+    def __init__(self):
+        self.flag = False
+        self.waiters = []
+        self.scheduler = None
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        self.flag = True
+
+        waiters, self.waiters = self.waiters, []
+        for coroutine in waiters:
+            self.scheduler.add_coroutine(coroutine)
+
+    def clear(self):
+        self.flag = False
+
+    def __await__(self):
+        yield self
+
+class Timeout(Exception):
+    """
+    Raised inside a coroutine whose I/O wait passed its deadline.
+    """
+
+class Watchdog(threading.Thread):
+    """
+    Samples the scheduler from another thread and records steps that run
+    longer than budget seconds, so the scheduler itself only pays for two
+    attribute writes per step.
+    """
+    def __init__(self, scheduler, budget):
+        super(Watchdog, self).__init__(name='scheduler-watchdog')
+        self.daemon = True
+        self.scheduler = scheduler
+        self.budget = budget
+        self.stopped = threading.Event()
+
+    def run(self):
+        step = None
+        started = None
+        reported = None
+
+        while not self.stopped.wait(self.budget / 2.0):
+            scheduler = self.scheduler
+            current = scheduler.current
+
+            if current is None or scheduler.steps != step:
+                step = scheduler.steps
+                started = clock()
+                continue
+
+            running = clock() - started
+            if step == reported or running < self.budget:
+                continue
+
+            reported = step
+            frame = sys._current_frames().get(scheduler.thread)
+            stack = ''.join(traceback.format_stack(frame)) if frame else ''
+
+            scheduler.long_steps.append({
+                'coroutine': current,
+                'name': getattr(current, '__name__', repr(current)),
+                'running': running,
+                'stack': stack,
+            })
+            logging.warning('%s has been running for at least %.3f seconds:\n%s', current, running, stack)
+
+    def stop(self):
+        self.stopped.set()
+
+class SchedulerStats:
+    """
+    Opt-in counters for a Scheduler: per coroutine sends, CPU time spent in
+    send(), time blocked on I/O and time awaiting a child, plus run queue
+    depth, epoll wakeups and events per wakeup. Finished coroutines are
+    folded into per-function totals.
+    """
+    def __init__(self):
+        self.coroutines = {}
+        self.functions = {}
+
+        self.iterations = 0
+        self.queue_depth = 0
+        self.queue_max = 0
+        self.queue_total = 0
+        self.wakeups = 0
+        self.events = 0
+
+    def record(self, coroutine):
+        record = self.coroutines.get(coroutine)
+
+        if record is None:
+            record = self.coroutines[coroutine] = {
+                'name': getattr(coroutine, '__name__', type(coroutine).__name__),
+                'sends': 0,
+                'cpu_time': 0.0,
+                'io_time': 0.0,
+                'await_time': 0.0,
+                'blocked': None,
+                'awaiting': None,
+            }
+
+        return record
+
+    def send(self, coroutine, args, exception):
+        record = self.record(coroutine)
+        record['sends'] += 1
+        started = cpu_clock()
+
+        try:
+            if exception is not None:
+                return coroutine.throw(exception)
+            return coroutine.send(args)
+        finally:
+            record['cpu_time'] += cpu_clock() - started
+
+    def blocked(self, coroutine):
+        self.record(coroutine)['blocked'] = clock()
+
+    def unblocked(self, coroutine):
+        record = self.record(coroutine)
+        if record['blocked'] is not None:
+            record['io_time'] += clock() - record['blocked']
+            record['blocked'] = None
+
+    def awaiting(self, coroutine):
+        self.record(coroutine)['awaiting'] = clock()
+
+    def resumed(self, coroutine):
+        record = self.record(coroutine)
+        if record['awaiting'] is not None:
+            record['await_time'] += clock() - record['awaiting']
+            record['awaiting'] = None
+
+    def finished(self, coroutine):
+        record = self.coroutines.pop(coroutine, None)
+        if record:
+            self.add_totals(self.functions, record)
+
+    def add_totals(self, functions, record):
+        totals = functions.setdefault(record['name'], {
+            'count': 0, 'sends': 0, 'cpu_time': 0.0, 'io_time': 0.0, 'await_time': 0.0,
+        })
+
+        totals['count'] += 1
+        for key in ('sends', 'cpu_time', 'io_time', 'await_time'):
+            totals[key] += record[key]
+
+    def iterated(self, queue_depth):
+        self.iterations += 1
+        self.queue_depth = queue_depth
+        self.queue_total += queue_depth
+        self.queue_max = max(self.queue_max, queue_depth)
+
+    def woke(self, events):
+        self.wakeups += 1
+        self.events += events
+
+    def snapshot(self, top=10):
+        """
+        Return the counters as a plain dict, with the top live coroutines by
+        CPU time and totals per function (finished and live).
+        """
+        live = [dict(record) for record in list(self.coroutines.values())]
+        live.sort(key=lambda record: record['cpu_time'], reverse=True)
+
+        functions = dict((name, dict(totals)) for name, totals in list(self.functions.items()))
+        for record in live:
+            self.add_totals(functions, record)
+
+        for record in live:
+            del record['blocked']
+            del record['awaiting']
+
+        return {
+            'time': clock(),
+            'iterations': self.iterations,
+            'queue_depth': self.queue_depth,
+            'queue_max': self.queue_max,
+            'queue_mean': self.queue_total / float(self.iterations) if self.iterations else 0.0,
+            'wakeups': self.wakeups,
+            'events': self.events,
+            'events_per_wakeup': self.events / float(self.wakeups) if self.wakeups else 0.0,
+            'live': len(live),
+            'coroutines': live[:top],
+            'functions': functions,
+        }
+
+class StatsSampler(threading.Thread):
+    """
+    Calls callback with a stats snapshot every interval seconds.
+    """
+    def __init__(self, stats, interval, callback):
+        super(StatsSampler, self).__init__(name='scheduler-stats')
+        self.daemon = True
+        self.stats = stats
+        self.interval = interval
+        self.callback = callback
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.callback(self.stats.snapshot())
+
+    def stop(self):
+        self.stopped.set()
+
 class Scheduler:
-    def __init__(self, timeout=0.1):
+    def __init__(self, timeout=0.1, stats=False):
+        # Steps running longer than timeout seconds are recorded in
+        # long_steps by a watchdog thread, None disables it.
         self.timeout = timeout
+        # SchedulerStats when stats=True, every hook checks for None first.
+        self.stats = SchedulerStats() if stats else None
+        self.samplers = []
 
         self.descriptors = 0
-        self.new_descriptors = Queue.Queue()
-        self.coroutines = Queue.Queue()
+        # The scheduler is single threaded, so the run queue and pending
+        # descriptors are plain deques. Other threads hand coroutines over
+        # through submit(), which is the only locked queue.
+        self.new_descriptors = collections.deque()
+        self.coroutines = collections.deque()
+        self.submitted = queue.Queue()
         self.poll = select.epoll()
 
+        # submit() writes to this pipe so a poll blocked on I/O or timers
+        # wakes up for new coroutines.
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.poll.register(self.wakeup[0], select.EPOLLIN)
+
+        # Heap of [deadline, sequence, coroutine, fd, active] timers, fd is
+        # None for Sleep. Cancelled timers are marked inactive and skipped.
+        self.timers = []
+        self.sequence = itertools.count()
+        # Mappings of coroutine -> timer for I/O waits with a deadline.
+        self.io_timers = {}
+        # Exceptions to throw into a coroutine the next time it runs.
+        self.exceptions = {}
+
         # Return values for each coroutine.
         self.coroutine_map = {}
         # Coroutines that ran early might have a buffered return value.
@@ -34,104 +318,240 @@ class Scheduler:
         self.parents = {}
         # Coroutines waiting for another coroutine.
         self.awaiting = set()
-
-        signal.signal(signal.SIGALRM, self.alarm_handler)
+        # Mappings of fd -> [(coroutine, mask), ...] waiting on it.
+        self.waiters = {}
+        # Mappings of fd -> [weakref to socket, mask registered with epoll].
+        # Sockets stay registered for their lifetime, only the mask changes.
+        self.registered = {}
+
+        # The coroutine currently being stepped, and a step counter, sampled
+        # by the watchdog.
+        self.current = None
+        self.steps = 0
+        self.thread = None
+        self.long_steps = collections.deque(maxlen=100)
+
+        self.watchdog = None
+        if timeout:
+            self.watchdog = Watchdog(self, timeout)
+            self.watchdog.start()
+
+        # What a coroutine yields is dispatched on its exact type, anything
+        # else is a return value.
+        self.handlers = {
+            tuple: self.handle_descriptor,
+            Wait: self.handle_wait,
+            Sleep: self.handle_sleep,
+            ScheduleTask: self.handle_task,
+            Event: self.handle_event,
+            types.GeneratorType: self.handle_child,
+        }
+        if hasattr(types, 'CoroutineType'):
+            self.handlers[types.CoroutineType] = self.handle_child
 
     def add_coroutine(self, coroutine):
-        logging.debug('adding coroutine: %s' % coroutine)
+        logging.debug('adding coroutine: %s', coroutine)
 #        traceback.print_stack()
-        self.coroutines.put(coroutine)
+        self.coroutines.append(coroutine)
 
-    def alarm_handler(self, signo, stack):
-        self.iterate()
+    def submit(self, coroutine):
+        """
+        Thread-safe add_coroutine, picked up at the start of the next iterate().
+        """
+        self.submitted.put(coroutine)
 
-        self.poll_descriptors()
-        signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        try:
+            os.write(self.wakeup[1], b'\0')
+        except OSError as e:
+            # The pipe is already full of wakeups.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def drain_submitted(self):
+        while not self.submitted.empty():
+            try:
+                self.coroutines.append(self.submitted.get(block=False))
+            except queue.Empty:
+                break
+
+    def sample_stats(self, interval, callback):
+        """
+        Call callback with stats.snapshot() every interval seconds from a
+        background thread until close(). The scheduler must have been created
+        with stats=True.
+        """
+        if self.stats is None:
+            raise ValueError('sample_stats() needs a Scheduler created with stats=True.')
+
+        sampler = StatsSampler(self.stats, interval, callback)
+        sampler.start()
+        self.samplers.append(sampler)
+
+    def close(self):
+        if self.watchdog:
+            self.watchdog.stop()
+            self.watchdog.join()
+
+        for sampler in self.samplers:
+            sampler.stop()
+            sampler.join()
+
+        self.poll.close()
+        for fd in self.wakeup:
+            os.close(fd)
 
     def iterate(self):
         previous = set()
 
-        while not self.coroutines.empty():
-            try:
-                coroutine = self.coroutines.get(block=False)
+        self.thread = threading.current_thread().ident
 
-                # Loop detection!
-#                if coroutine in previous:
-#                    logging.debug('loop detected, rescheduling %s' % coroutine)
-#                    self.add_coroutine(coroutine)
-#                    break
+        self.drain_submitted()
 
-                self.run_coroutine(coroutine)
-                previous.add(coroutine)
-            except Queue.Empty:
-                break
+        # After the drain, so coroutines handed over by submit() are counted.
+        if self.stats is not None:
+            self.stats.iterated(len(self.coroutines))
+
+        while self.coroutines:
+            coroutine = self.coroutines.popleft()
+
+            # Loop detection!
+#            if coroutine in previous:
+#                logging.debug('loop detected, rescheduling %s', coroutine)
+#                self.add_coroutine(coroutine)
+#                break
+
+            self.run_coroutine(coroutine)
+            previous.add(coroutine)
 
         self.poll_descriptors()
 
     def run_coroutine(self, coroutine):
+        # Coroutines waiting on a child are parked off the run queue,
+        # get_parent() reschedules them once the child resolves.
         if coroutine in self.awaiting:
-            logging.debug('%s is waiting, adding back to queue.' % (coroutine))
-            self.add_coroutine(coroutine)
+            logging.debug('%s is waiting, parking it.', coroutine)
             return
 
-        signal.setitimer(signal.ITIMER_REAL, self.timeout)
+        self.steps += 1
+        self.current = coroutine
 
         # Run the coroutine.
         try:
-            args = self.coroutine_map.get(coroutine)
-            # We need to remove the return value so it doesn't get reused.
-            if args:
-                self.coroutine_map[coroutine] = args[1:]
-                if not self.coroutine_map:
-                    del self.coroutine_map[coroutine]
-                args = args[0]
-
-            logging.debug('calling %s with %s' % (coroutine, args))
-            result = coroutine.send(args)
-            logging.debug('got %s from %s' % (result, coroutine))
+            exception = self.exceptions.pop(coroutine, None)
+            args = None
+
+            if exception is not None:
+                logging.debug('throwing %s into %s', exception, coroutine)
+            else:
+                args = self.coroutine_map.get(coroutine)
+                # We need to remove the return value so it doesn't get reused.
+                if args:
+                    self.coroutine_map[coroutine] = args[1:]
+                    if not self.coroutine_map:
+                        del self.coroutine_map[coroutine]
+                    args = args[0]
+
+                logging.debug('calling %s with %s', coroutine, args)
+
+            if self.stats is not None:
+                result = self.stats.send(coroutine, args, exception)
+            elif exception is not None:
+                result = coroutine.throw(exception)
+            else:
+                result = coroutine.send(args)
+
+            logging.debug('got %s from %s', result, coroutine)
             self.handle_result(coroutine, result)
-        except StopIteration:
-            signal.setitimer(signal.ITIMER_REAL, 0)
-            # The coroutine completed, so schedule the parent, if any.
+        except StopIteration as e:
+            if self.stats is not None:
+                self.stats.finished(coroutine)
+
+            # The coroutine completed, so schedule the parent, if any. Native
+            # and Python 3 generator coroutines can also return a value.
             parent = self.get_parent(coroutine)
             if parent:
+                value = getattr(e, 'value', None)
+                if value is not None:
+                    self.add_result(parent, value)
                 self.add_coroutine(parent)
+        except Exception as e:
+            if self.stats is not None:
+                self.stats.finished(coroutine)
 
-        signal.setitimer(signal.ITIMER_REAL, 0)
+            # Hand the exception to the parent, top level coroutines still
+            # take the scheduler down.
+            parent = self.get_parent(coroutine)
+            if not parent:
+                raise
+
+            self.exceptions[parent] = e
+            self.add_coroutine(parent)
+        finally:
+            self.current = None
 
     def handle_result(self, coroutine, result):
-        new_descriptor = None
-
-        # Inherits from NonBlocking, schedule the descriptor and add a mapping.
-        if isinstance(result, tuple) and len(result) == 2 and hasattr(result[0], 'fileno'):
-            self.parents[result[0].fileno()] = coroutine
-            self.new_descriptors.put(result)
-        # It's a ScheduleTask object, schedule the task and the parent (don't
-        # associate the task with the parent - "threads")
-        elif isinstance(result, ScheduleTask):
-            self.add_coroutine(result.coroutine)
+        self.handlers.get(type(result), self.handle_value)(coroutine, result)
+
+    def handle_descriptor(self, coroutine, result):
+        # A (socket, mask) pair, schedule the descriptor and add a mapping.
+        # An optional third item is a timeout in seconds.
+        if len(result) not in (2, 3) or not hasattr(result[0], 'fileno'):
+            return self.handle_value(coroutine, result)
+
+        self.wait_descriptor(coroutine, *result)
+
+    def handle_wait(self, coroutine, wait):
+        self.wait_descriptor(coroutine, wait.sock, wait.mask, wait.timeout)
+
+    def wait_descriptor(self, coroutine, sock, mask, timeout=None):
+        deadline = None
+        if timeout is not None:
+            deadline = clock() + timeout
+        self.new_descriptors.append((sock, mask, coroutine, deadline))
+
+    def handle_sleep(self, coroutine, result):
+        # Wake the coroutine back up after the given number of seconds.
+        self.add_timer(clock() + result.seconds, coroutine)
+
+    def handle_task(self, coroutine, result):
+        # Schedule the task and the parent (don't associate the task with the
+        # parent - "threads")
+        self.add_coroutine(result.coroutine)
+        self.add_coroutine(coroutine)
+
+    def handle_event(self, coroutine, event):
+        # Park the coroutine on the event until it is set.
+        if event.flag:
             self.add_coroutine(coroutine)
+        else:
+            event.scheduler = self
+            event.waiters.append(coroutine)
+
+    def handle_child(self, coroutine, result):
         # Schedule the new generator and map it to the parent.
-        elif isinstance(result, types.GeneratorType):
-            if result in self.buffered_returns:
-                self.add_result(coroutine, self.buffered_returns[result])
-                del self.buffered_returns[result]
-                self.add_coroutine(result)
-                self.add_coroutine(coroutine)
-            else:
-                self.add_coroutine(result)
-                self.parents[result] = coroutine
-                self.awaiting.add(coroutine)
-        # Otherwise call the coroutine again so that it completes and then
-        # store the result.
+        if result in self.buffered_returns:
+            self.add_result(coroutine, self.buffered_returns[result])
+            del self.buffered_returns[result]
+            self.add_coroutine(result)
+            self.add_coroutine(coroutine)
         else:
-            parent = self.get_parent(coroutine)
-            if parent:
-                self.add_result(parent, result)
-                self.add_coroutine(coroutine)
-                self.add_coroutine(parent)
-            else:
-                self.buffered_returns[coroutine] = result
+            self.add_coroutine(result)
+            self.parents[result] = coroutine
+            self.awaiting.add(coroutine)
+
+            if self.stats is not None:
+                self.stats.awaiting(coroutine)
+
+    def handle_value(self, coroutine, result):
+        # Call the coroutine again so that it completes and then store the
+        # result.
+        parent = self.get_parent(coroutine)
+        if parent:
+            self.add_result(parent, result)
+            self.add_coroutine(coroutine)
+            self.add_coroutine(parent)
+        else:
+            self.buffered_returns[coroutine] = result
 
     def add_result(self, parent, result):
         if parent not in self.coroutine_map:
@@ -142,27 +562,155 @@ class Scheduler:
     def poll_descriptors(self):
         logging.debug('Adding descriptors')
 
-        while not self.new_descriptors.empty():
-            try:
-                fd, mask = self.new_descriptors.get(block=False)
-            except Queue.Empty:
-                break
+        # Batch the interest changes so each fd gets at most one
+        # register/modify no matter how many coroutines started waiting on it.
+        changed = {}
+
+        while self.new_descriptors:
+            sock, mask, coroutine, deadline = self.new_descriptors.popleft()
 
             if isinstance(mask, tuple):
                 mask = reduce(lambda x, y: x | y, mask)
-            self.poll.register(fd, mask)
+
+            fd = sock.fileno()
+            self.waiters.setdefault(fd, []).append((coroutine, mask))
+            changed[fd] = sock
             self.descriptors += 1
 
-        if not self.descriptors:
-            return
+            if self.stats is not None:
+                self.stats.blocked(coroutine)
 
-        for fd, events in self.poll.poll(0 if self.coroutines else 100):
-            logging.debug('%s is active! scheduling %s' % (fd, self.parents[fd]))
-            self.add_coroutine(self.parents[fd])
-            del self.parents[fd]
-            self.poll.unregister(fd)
+            if deadline is not None:
+                self.io_timers[coroutine] = self.add_timer(deadline, coroutine, fd)
+
+        for fd, sock in changed.items():
+            self.update_interest(fd, sock)
+
+        if self.descriptors or self.timers:
+            ready = self.poll.poll(self.poll_timeout())
+
+            if self.stats is not None:
+                self.stats.woke(len(ready))
+
+            for fd, events in ready:
+                if fd == self.wakeup[0]:
+                    self.drain_wakeup()
+                    continue
+
+                waiters = self.waiters.pop(fd, [])
+                remaining = []
+
+                for coroutine, mask in waiters:
+                    if events & (mask | select.EPOLLERR | select.EPOLLHUP):
+                        logging.debug('%s is active! scheduling %s', fd, coroutine)
+                        self.cancel_timer(coroutine)
+                        self.add_coroutine(coroutine)
+
+                        if self.stats is not None:
+                            self.stats.unblocked(coroutine)
+                        self.descriptors -= 1
+                    else:
+                        remaining.append((coroutine, mask))
+
+                if remaining:
+                    self.waiters[fd] = remaining
+                    self.update_interest(fd)
+                elif not waiters:
+                    self.disarm(fd, events)
+
+        self.fire_timers()
+
+    def poll_timeout(self):
+        """
+        Block until the nearest deadline, or indefinitely if there is none.
+        """
+        if self.coroutines:
+            return 0
+
+        if self.timers:
+            return max(self.timers[0][0] - clock(), 0)
+
+        return -1
+
+    def drain_wakeup(self):
+        try:
+            while os.read(self.wakeup[0], 4096):
+                pass
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def add_timer(self, deadline, coroutine, fd=None):
+        timer = [deadline, next(self.sequence), coroutine, fd, True]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel_timer(self, coroutine):
+        timer = self.io_timers.pop(coroutine, None)
+        if timer:
+            timer[4] = False
+
+    def fire_timers(self):
+        now = clock()
+
+        while self.timers and (not self.timers[0][4] or self.timers[0][0] <= now):
+            deadline, _, coroutine, fd, active = heapq.heappop(self.timers)
+            if not active:
+                continue
+
+            if fd is None:
+                logging.debug('%s finished sleeping', coroutine)
+                self.add_coroutine(coroutine)
+                continue
+
+            logging.debug('%s timed out waiting on %s', coroutine, fd)
+            del self.io_timers[coroutine]
+
+            waiters = [waiter for waiter in self.waiters.pop(fd, []) if waiter[0] is not coroutine]
+            if waiters:
+                self.waiters[fd] = waiters
+                self.update_interest(fd)
             self.descriptors -= 1
 
+            if self.stats is not None:
+                self.stats.unblocked(coroutine)
+
+            self.exceptions[coroutine] = Timeout('timed out waiting on fd %d' % fd)
+            self.add_coroutine(coroutine)
+
+    def update_interest(self, fd, sock=None):
+        mask = 0
+        for _, waiter_mask in self.waiters.get(fd, []):
+            mask |= waiter_mask
+
+        entry = self.registered.get(fd)
+
+        # A new socket, or a new socket that reused the fd of a closed one.
+        if sock is not None and (entry is None or entry[0]() is not sock):
+            try:
+                self.poll.register(fd, mask)
+            except (IOError, OSError) as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                self.poll.modify(fd, mask)
+
+            self.registered[fd] = [weakref.ref(sock), mask]
+        elif entry[1] != mask:
+            self.poll.modify(fd, mask)
+            entry[1] = mask
+
+    def disarm(self, fd, events):
+        """
+        Nobody is waiting on fd any more, but it was left registered in case
+        the next wait wants the same mask. Stop it firing.
+        """
+        if events & (select.EPOLLERR | select.EPOLLHUP):
+            self.poll.unregister(fd)
+            del self.registered[fd]
+        else:
+            self.poll.modify(fd, 0)
+            self.registered[fd][1] = 0
+
     def get_parent(self, coroutine):
         parent = self.parents.get(coroutine)
 
@@ -174,39 +722,277 @@ class Scheduler:
         if parent in self.awaiting:
             self.awaiting.remove(parent)
 
+            if self.stats is not None:
+                self.stats.resumed(parent)
+
         return parent
 
     def run_until_complete(self):
-        while not self.coroutines.empty() or self.descriptors:
+        while self.coroutines or self.descriptors or self.timers or not self.submitted.empty():
             self.iterate()
 
 class Socket(socket.socket):
+    # Size of the internal read buffer used by readline/readexactly, it is
+    # allocated on first use and grown if a single read needs more.
+    buffer_size = 65536
+
+    # The underlying non-blocking calls, the instance replaces send, recv
+    # and recv_into with coroutines. Python 2 sockets delegate to _sock,
+    # which must not be referenced from the instance or close() leaks the fd.
+    if PY2:
+        raw_send = property(lambda self: self._sock.send)
+        raw_recv = property(lambda self: self._sock.recv)
+        raw_recv_into = property(lambda self: self._sock.recv_into)
+    else:
+        raw_send = socket.socket.send
+        raw_recv = socket.socket.recv
+        raw_recv_into = socket.socket.recv_into
+
     def __init__(self, *args, **kwargs):
         super(Socket, self).__init__(*args, **kwargs)
         self.setblocking(0)
 
         self.send = self._send
         self.recv = self._recv
+        self.recv_into = self._recv_into
 
-    def accept(self):
-        yield self, States.READABLE
-        client, addr = super(Socket, self).accept()
-        yield addr, Socket(_sock=client)
+        self.read_buffer = None
+        self.read_start = 0
+        self.read_end = 0
 
-    def connect(self, host):
-        yield self, States.WRITABLE
+    def accept(self, timeout=None):
+        yield self, States.READABLE, timeout
+        client, addr = super(Socket, self).accept()
+        if PY2:
+            client = Socket(_sock=client)
+        else:
+            client = Socket(fileno=client.detach())
+        yield addr, client
 
+    def connect(self, host, timeout=None):
+        # Start the non-blocking connect and wait for it to finish, so the
+        # timeout covers the handshake.
         try:
-            yield super(Socket, self).connect(host)
+            super(Socket, self).connect(host)
         except socket.error:
             pass
 
-    def _send(self, data):
+        yield self, States.WRITABLE, timeout
+
+        # Writable only says the handshake finished, not that it worked.
+        error = self.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise socket.error(error, os.strerror(error))
+
+    def _send(self, data, timeout=None):
+        # Slicing a memoryview doesn't copy the unsent remainder.
+        view = memoryview(data)
         sent_bytes = 0
-        while sent_bytes < len(data):
-            yield self, States.WRITABLE
-            sent_bytes += self._sock.send(data[sent_bytes:])
+        while sent_bytes < len(view):
+            yield self, States.WRITABLE, timeout
+            sent_bytes += self.raw_send(view[sent_bytes:])
+
+    def _recv(self, num_bytes, timeout=None):
+        if self.read_end > self.read_start:
+            yield self._consume(min(num_bytes, self.read_end - self.read_start))
+            return
+
+        yield self, States.READABLE, timeout
+        yield self.raw_recv(num_bytes)
+
+    def _recv_into(self, buffer, num_bytes=0, timeout=None):
+        """
+        Read into a caller supplied buffer and return the number of bytes
+        read, without allocating.
+        """
+        view = memoryview(buffer)
+        num_bytes = num_bytes or len(view)
+
+        pending = self.read_end - self.read_start
+        if pending:
+            count = min(num_bytes, pending)
+            view[:count] = memoryview(self.read_buffer)[self.read_start:self.read_start + count]
+            self.read_start += count
+            yield count
+            return
 
-    def _recv(self, num_bytes):
-        yield self, States.READABLE
-        yield self._sock.recv(num_bytes)
+        yield self, States.READABLE, timeout
+        yield self.raw_recv_into(view, num_bytes)
+
+    def readexactly(self, num_bytes, timeout=None):
+        while self.read_end - self.read_start < num_bytes:
+            yield self, States.READABLE, timeout
+            if self._fill(num_bytes) == 0:
+                raise EOFError('connection closed with %d of %d bytes read' % (self.read_end - self.read_start, num_bytes))
+
+        yield self._consume(num_bytes)
+
+    def readline(self, timeout=None):
+        """
+        Read up to and including the next newline, or whatever is left when
+        the connection closes.
+        """
+        scanned = self.read_start
+
+        while True:
+            if self.read_buffer is not None:
+                index = self.read_buffer.find(b'\n', scanned, self.read_end)
+                if index >= 0:
+                    yield self._consume(index + 1 - self.read_start)
+                    return
+                scanned = self.read_end
+
+            yield self, States.READABLE, timeout
+
+            # _fill may compact the buffer, keep the scan offset relative.
+            scanned -= self.read_start
+            count = self._fill()
+            scanned += self.read_start
+
+            if count == 0:
+                yield self._consume(self.read_end - self.read_start)
+                return
+
+    def _fill(self, needed=0):
+        """
+        Read whatever is available into the internal buffer. Return the
+        number of bytes read, 0 on EOF and None if the read would block.
+        """
+        pending = self.read_end - self.read_start
+
+        if self.read_buffer is None:
+            self.read_buffer = bytearray(max(self.buffer_size, needed))
+        elif not pending:
+            self.read_start = self.read_end = 0
+        elif self.read_end == len(self.read_buffer) or self.read_start + needed > len(self.read_buffer):
+            # Move the unread bytes to the front, and grow if that's not enough.
+            self.read_buffer[:pending] = self.read_buffer[self.read_start:self.read_end]
+            self.read_start, self.read_end = 0, pending
+
+            if pending == len(self.read_buffer) or needed > len(self.read_buffer):
+                self.read_buffer.extend(bytearray(max(len(self.read_buffer), needed - len(self.read_buffer))))
+
+        try:
+            count = self.raw_recv_into(memoryview(self.read_buffer)[self.read_end:])
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return None
+            raise
+
+        self.read_end += count
+        return count
+
+    def _consume(self, num_bytes):
+        data = memoryview(self.read_buffer)[self.read_start:self.read_start + num_bytes].tobytes()
+        self.read_start += num_bytes
+        return data
+
+def reuseport_socket(sock_class=socket.socket):
+    sock = sock_class()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return sock
+
+def accept_until(server, handler, stats, deadline):
+    """
+    Accept clients and schedule handler(client, addr) for each one until
+    deadline, then close the listener.
+    """
+    while True:
+        remaining = deadline - clock()
+        if remaining <= 0:
+            break
+
+        try:
+            addr, client = yield server.accept(timeout=remaining)
+        except Timeout:
+            break
+
+        stats['accepted'] += 1
+        yield ScheduleTask(handler(client, addr))
+
+    yield server.close()
+
+class ShardedServer:
+    """
+    Forks one Scheduler per process, each accepting on its own SO_REUSEPORT
+    listener, so the kernel load-balances connections across cores. Every
+    child reports its stats back to the parent through its own pipe.
+    """
+    def __init__(self, address, handler, processes=None, backlog=128):
+        self.handler = handler
+        self.processes = processes or multiprocessing.cpu_count()
+        self.backlog = backlog
+
+        # Hold the port with a bound socket that never listens (so it never
+        # gets connections), letting every child bind it even for port 0.
+        self.reservation = reuseport_socket()
+        self.reservation.bind(address)
+        self.address = self.reservation.getsockname()
+
+        # (process, read end of its stats pipe) for each child.
+        self.workers = []
+
+    def start(self, duration):
+        for _ in range(self.processes):
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            worker = multiprocessing.Process(target=self.serve, args=(duration, writer))
+            worker.start()
+            # Only the child holds the write end now, so recv() fails rather
+            # than blocks if the child dies without reporting.
+            writer.close()
+            self.workers.append((worker, reader))
+
+    def serve(self, duration, writer):
+        server = reuseport_socket(Socket)
+        server.bind(self.address)
+        server.listen(self.backlog)
+
+        stats = {'pid': os.getpid(), 'accepted': 0}
+
+        scheduler = Scheduler()
+        scheduler.add_coroutine(accept_until(server, self.handler, stats, clock() + duration))
+
+        start = clock()
+        scheduler.run_until_complete()
+        stats['elapsed'] = clock() - start
+        stats['steps'] = scheduler.steps
+        stats['long_steps'] = len(scheduler.long_steps)
+        scheduler.close()
+
+        writer.send(stats)
+        writer.close()
+
+    def join(self):
+        """
+        Wait for every child and return the aggregated stats. Children that
+        died without reporting are logged and counted as failed.
+        """
+        workers = []
+        failed = 0
+
+        for worker, reader in self.workers:
+            try:
+                workers.append(reader.recv())
+            except EOFError:
+                worker.join()
+                logging.error('Server process %d exited with code %s without reporting.', worker.pid, worker.exitcode)
+                failed += 1
+
+            reader.close()
+            worker.join()
+
+        self.workers = []
+        self.reservation.close()
+
+        accepted = sum(stats['accepted'] for stats in workers)
+        elapsed = max([stats['elapsed'] for stats in workers] or [0.0])
+
+        return {
+            'processes': len(workers),
+            'failed': failed,
+            'accepted': accepted,
+            'elapsed': elapsed,
+            'rate': accepted / elapsed if elapsed else 0.0,
+            'workers': workers,
+        }
@@ -0,0 +1,333 @@
+"""
+The subset of the asyncio API used by the http_streams.py client,
+running on coroutine.Scheduler so the same client code can be benchmarked
+against asyncio and uvloop. Python 3 only.
+"""
+import collections
+import errno
+import logging
+import os
+import socket
+import coroutine
+
+FIRST_COMPLETED = 'FIRST_COMPLETED'
+ALL_COMPLETED = 'ALL_COMPLETED'
+
+_loop = None
+
+class EventLoop:
+    def __init__(self, **kwargs):
+        self.scheduler = coroutine.Scheduler(**kwargs)
+
+    def create_future(self):
+        return Future()
+
+    def create_task(self, coro):
+        task = Task(coro)
+        self.scheduler.add_coroutine(task.run())
+        return task
+
+    def run_until_complete(self, future):
+        global _loop
+        previous, _loop = _loop, self
+
+        try:
+            task = ensure_future(future, loop=self)
+            self.scheduler.run_until_complete()
+        finally:
+            _loop = previous
+
+        if not task.done():
+            raise RuntimeError('Event loop stopped before Future completed.')
+
+        return task.result()
+
+    def close(self):
+        self.scheduler.close()
+
+def new_event_loop():
+    return EventLoop()
+
+def get_event_loop():
+    global _loop
+
+    if _loop is None:
+        _loop = new_event_loop()
+
+    return _loop
+
+class Future:
+    def __init__(self):
+        self.finished = coroutine.Event()
+        self.callbacks = []
+        self._result = None
+        self._exception = None
+        self._retrieved = False
+
+    def set_result(self, result):
+        if self.done():
+            raise RuntimeError('Future is already done.')
+
+        self._result = result
+        self.finish()
+
+    def set_exception(self, exception):
+        if self.done():
+            raise RuntimeError('Future is already done.')
+
+        self._exception = exception
+        self.finish()
+
+    def finish(self):
+        self.finished.set()
+
+        for callback in self.callbacks:
+            callback(self)
+        self.callbacks = []
+
+    def done(self):
+        return self.finished.is_set()
+
+    def result(self):
+        if not self.done():
+            raise RuntimeError('Result is not ready.')
+
+        self._retrieved = True
+        if self._exception is not None:
+            raise self._exception
+
+        return self._result
+
+    def exception(self):
+        self._retrieved = True
+        return self._exception
+
+    def add_done_callback(self, callback):
+        if self.done():
+            callback(self)
+        else:
+            self.callbacks.append(callback)
+
+    def __await__(self):
+        if not self.done():
+            yield self.finished
+
+        return self.result()
+
+    def __del__(self):
+        if self._exception is not None and not self._retrieved:
+            logging.error('%s exception was never retrieved: %r', type(self).__name__, self._exception)
+
+class Task(Future):
+    def __init__(self, coro):
+        super().__init__()
+        self.coro = coro
+
+    async def run(self):
+        try:
+            result = await self.coro
+        except Exception as e:
+            self.set_exception(e)
+        else:
+            self.set_result(result)
+
+def ensure_future(coro_or_future, loop=None):
+    if isinstance(coro_or_future, Future):
+        return coro_or_future
+
+    return (loop or get_event_loop()).create_task(coro_or_future)
+
+async def wait(fs, loop=None, return_when=ALL_COMPLETED):
+    """
+    Wait for the tasks in fs and return the (done, pending) sets.
+    """
+    tasks = set(ensure_future(f, loop=loop) for f in fs)
+    pending = set(task for task in tasks if not task.done())
+
+    if return_when == ALL_COMPLETED:
+        for task in pending:
+            await task.finished
+    elif pending and len(pending) == len(tasks):
+        event = coroutine.Event()
+        for task in pending:
+            task.add_done_callback(lambda task: event.set())
+        await event
+
+    done = set(task for task in tasks if task.done())
+    return done, tasks - done
+
+async def sleep(delay, result=None):
+    await coroutine.Sleep(delay)
+    return result
+
+class Lock:
+    def __init__(self, loop=None):
+        self._locked = False
+        self.waiters = collections.deque()
+
+    async def acquire(self):
+        while self._locked:
+            event = coroutine.Event()
+            self.waiters.append(event)
+            await event
+
+        self._locked = True
+        return True
+
+    def release(self):
+        if not self._locked:
+            raise RuntimeError('Lock is not acquired.')
+
+        self._locked = False
+        if self.waiters:
+            self.waiters.popleft().set()
+
+    def locked(self):
+        return self._locked
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+class Semaphore:
+    def __init__(self, value=1, loop=None):
+        if value < 0:
+            raise ValueError('Semaphore initial value must be >= 0')
+
+        self._value = value
+        self.waiters = collections.deque()
+
+    async def acquire(self):
+        while self._value <= 0:
+            event = coroutine.Event()
+            self.waiters.append(event)
+            await event
+
+        self._value -= 1
+        return True
+
+    def release(self):
+        self._value += 1
+        if self.waiters:
+            self.waiters.popleft().set()
+
+    def locked(self):
+        return self._value == 0
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+async def open_connection(host, port, loop=None):
+    sock = socket.socket()
+    sock.setblocking(False)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    try:
+        sock.connect((host, port))
+    except BlockingIOError:
+        pass
+
+    await coroutine.Wait(sock, coroutine.States.WRITABLE)
+
+    error = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    if error:
+        sock.close()
+        raise OSError(error, 'Connect call failed %s: %s' % ((host, port), os.strerror(error)))
+
+    return StreamReader(sock), StreamWriter(sock)
+
+class StreamReader:
+    def __init__(self, sock):
+        self.sock = sock
+        self.eof = False
+
+    async def read(self, n=65536):
+        while True:
+            try:
+                data = self.sock.recv(n)
+            except BlockingIOError:
+                await coroutine.Wait(self.sock, coroutine.States.READABLE)
+                continue
+
+            self.eof = not data
+            return data
+
+    def at_eof(self):
+        """
+        Whether the peer closed the connection and everything was read. There
+        is no transport reading in the background, so this peeks.
+        """
+        if not self.eof:
+            try:
+                self.eof = not self.sock.recv(1, socket.MSG_PEEK)
+            except BlockingIOError:
+                pass
+            except OSError:
+                self.eof = True
+
+        return self.eof
+
+class StreamWriter:
+    """
+    write() sends as much as the socket takes straight away and leaves the
+    rest to a flusher coroutine, like an asyncio transport.
+    """
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray()
+        self.flushed = coroutine.Event()
+        self.flushed.set()
+        self.closing = False
+
+    def write(self, data):
+        if self.closing:
+            raise RuntimeError('write() after close()')
+
+        if not self.buffer:
+            try:
+                sent = self.sock.send(data)
+            except BlockingIOError:
+                sent = 0
+
+            if sent == len(data):
+                return
+
+            data = memoryview(data)[sent:]
+            self.flushed.clear()
+            get_event_loop().scheduler.add_coroutine(self.flush())
+
+        self.buffer.extend(data)
+
+    async def flush(self):
+        while self.buffer:
+            await coroutine.Wait(self.sock, coroutine.States.WRITABLE)
+
+            try:
+                sent = self.sock.send(self.buffer)
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    del self.buffer[:]
+                    logging.error('Error writing to %s: %s', self.sock, e)
+                    break
+                sent = 0
+
+            del self.buffer[:sent]
+
+        self.flushed.set()
+
+        if self.closing:
+            self.sock.close()
+
+    async def drain(self):
+        await self.flushed
+
+    def close(self):
+        self.closing = True
+
+        if not self.buffer:
+            self.sock.close()
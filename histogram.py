@@ -0,0 +1,130 @@
+class Histogram:
+    """
+    Log-linear (HDR-style) histogram of integer values, usually nanoseconds.
+
+    Values below 2**precision are counted exactly, larger values are grouped
+    into buckets that are 2**(precision - 1) wide per power of two, so the
+    relative error is bounded by 2**(1 - precision) regardless of magnitude.
+    Counts are kept in a sparse dict so histograms are cheap to pickle and
+    merge across threads and processes.
+    """
+    def __init__(self, precision=7):
+        self.precision = precision
+        self.counts = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def index(self, value):
+        shift = max(value.bit_length() - self.precision, 0)
+        return (shift << (self.precision - 1)) + (value >> shift)
+
+    def highest_equivalent(self, index):
+        if index < (1 << self.precision):
+            return index
+
+        shift = (index >> (self.precision - 1)) - 1
+        sub_bucket = index - (shift << (self.precision - 1))
+        return ((sub_bucket + 1) << shift) - 1
+
+    def record(self, value, count=1):
+        index = self.index(value)
+        self.counts[index] = self.counts.get(index, 0) + count
+        self.count += count
+        self.total += value * count
+
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Cannot merge histograms with precision %d and %d.' % (self.precision, other.precision))
+
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+
+        self.count += other.count
+        self.total += other.total
+
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+        return self
+
+    def percentile(self, percentile):
+        if not self.count:
+            return 0
+
+        target = max(percentile / 100.0 * self.count, 1)
+        seen = 0
+
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= target:
+                return min(self.highest_equivalent(index), self.max)
+
+        return self.max
+
+    def mean(self):
+        if not self.count:
+            return 0
+
+        return self.total / self.count
+
+    def variance(self):
+        """
+        Approximate the sample variance from the bucket midpoints.
+        """
+        if self.count < 2:
+            return 0.0
+
+        mean = self.mean()
+        squares = 0.0
+
+        for index, count in self.counts.items():
+            low = self.highest_equivalent(index - 1) + 1 if index else 0
+            midpoint = (low + self.highest_equivalent(index)) / 2.0
+            squares += count * (midpoint - mean) ** 2
+
+        return squares / (self.count - 1)
+
+    def to_dict(self):
+        return {
+            'precision': self.precision,
+            'counts': sorted(self.counts.items()),
+            'count': self.count,
+            'total': self.total,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(data['precision'])
+        histogram.counts = dict((index, count) for index, count in data['counts'])
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.min = data['min']
+        histogram.max = data['max']
+        return histogram
+
+    def summary(self, percentiles=(50, 90, 99, 99.9)):
+        """
+        Return a dict of the count, mean, min, max and requested percentiles.
+        """
+        summary = {
+            'count': self.count,
+            'mean': self.mean(),
+            'min': self.min or 0,
+            'max': self.max or 0,
+        }
+
+        for percentile in percentiles:
+            summary['p%s' % percentile] = self.percentile(percentile)
+
+        return summary
@@ -0,0 +1,200 @@
+"""
+Pipelining HTTP/1.1 client pool built on asyncio protocols, for asyncio and
+uvloop.
+"""
+import asyncio
+import collections
+import time
+import httppool
+from httpparser import ParseError, ResponseParser
+
+class Connection(asyncio.Protocol):
+    def __init__(self, host, port, pool, loop):
+        # Whether or not a connection is established.
+        self.connected = asyncio.Event()
+        # Only one worker opens the connection, the others wait for it.
+        self.connect_lock = asyncio.Lock()
+
+        self.pool = pool
+
+        # Futures for the requests in flight, responses arrive in the same
+        # order the requests were written.
+        self.pending = collections.deque()
+        # Requests written this loop iteration, flushed together with one
+        # writelines() so pipelined requests share a syscall.
+        self.outgoing = []
+        self.parser = ResponseParser(keep_body=False)
+
+        self.host = host
+        self.port = port
+
+        self.loop = loop
+        self.transport = None
+
+        # Closed takes no new requests, retired has been replaced in the
+        # pool and closes once its requests in flight are answered. eof is
+        # set when the server closed the connection or said it would.
+        self.closed = False
+        self.retired = False
+        self.eof = False
+        self.requests = 0
+        self.last_used = time.monotonic()
+
+    # Asychronous protocol handlers.
+    def connection_made(self, transport):
+        self.transport = transport
+        self.parser = ResponseParser(keep_body=False)
+        self.connected.set()
+
+    def connection_lost(self, exc):
+        self.connected.clear()
+
+        if not self.closed:
+            self.closed = True
+            self.eof = True
+
+        # The last response might have been delimited by the close.
+        if self.pending:
+            try:
+                self.resolve(self.parser.eof())
+            except ParseError:
+                pass
+
+        # Requests that never got a response.
+        while self.pending:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_result(None)
+
+        # Reopen right away rather than on the next request.
+        self.pool.retire(self)
+
+    def data_received(self, data):
+        self.parser.feed(data)
+
+        while self.pending:
+            try:
+                response = self.parser.next(head=self.pool.head)
+            except ParseError:
+                # The stream can't be resynchronised, connection_lost()
+                # answers everything in flight with None.
+                self.close()
+                return
+
+            if response is None:
+                break
+
+            self.resolve(response)
+
+            # The server closes after this response, anything pipelined
+            # behind it is lost.
+            if not self.eof and response.header(b'connection', b'').lower() == b'close':
+                self.eof = True
+                self.pool.retire(self)
+
+        if self.retired and not self.pending:
+            self.close()
+
+    def resolve(self, response):
+        future = self.pending.popleft()
+        if not future.done():
+            future.set_result(response)
+
+    # Coroutines used by pool / user.
+    async def connect(self):
+        """
+        Return immediately if already connected, otherwise open a new connection and wait
+        for it to be established.
+        """
+        async with self.connect_lock:
+            if self.connected.is_set():
+                return
+
+            start = time.monotonic()
+
+            try:
+                await self.loop.create_connection(lambda: self, self.host, self.port)
+            except OSError:
+                self.pool.failures += 1
+                raise
+
+            await self.connected.wait()
+            self.pool.connected(time.monotonic() - start)
+
+    async def send(self, message):
+        """
+        Queue a request (bytes) without waiting for earlier responses and return a
+        future for its response, which is None if the connection closed.
+        """
+        future = self.loop.create_future()
+
+        if self.closed or self.eof:
+            future.set_result(None)
+            return future
+
+        await self.connect()
+
+        self.pending.append(future)
+        self.outgoing.append(message)
+        if len(self.outgoing) == 1:
+            self.loop.call_soon(self.flush)
+
+        self.requests += 1
+        self.pool.requests += 1
+        if self.pool.max_requests and self.requests >= self.pool.max_requests:
+            self.pool.retire(self)
+
+        return future
+
+    def flush(self):
+        if not self.transport.is_closing():
+            self.transport.writelines(self.outgoing)
+
+        self.outgoing = []
+
+    async def request(self, message):
+        return await (await self.send(message))
+
+    def healthy(self, idle=False):
+        """
+        Whether the connection can take another request: it is open (or not
+        opened yet), not retired and not idle for longer than idle_ttl. idle
+        makes no difference, a close is seen as soon as it arrives.
+        """
+        if self.closed or self.retired:
+            return False
+
+        return not self.pool.idle_ttl or time.monotonic() - self.last_used < self.pool.idle_ttl
+
+    def release(self):
+        """
+        Release the connection back into the pool.
+        """
+        self.pool.release(self)
+
+    def close(self):
+        """
+        Close the connection.
+        """
+        self.closed = True
+
+        if self.transport:
+            self.transport.close()
+
+class Pool(httppool.Pool):
+    """
+    A connection takes depth requests at once, each pipelined behind
+    whatever is in flight on it.
+    """
+    def __init__(self, host, port, conn_limit, loop, depth=1, head=True, max_requests=0, idle_ttl=0):
+        super().__init__(asyncio, host, port, conn_limit, loop, head=head, max_requests=max_requests, idle_ttl=idle_ttl)
+        self.depth = depth
+
+    def new_connection(self):
+        return Connection(self.host, self.port, self, self.loop)
+
+    def drop(self, connection):
+        # Requests in flight are still answered, data_received() closes
+        # the connection after the last one.
+        if not connection.pending:
+            connection.close()
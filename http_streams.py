@@ -0,0 +1,115 @@
+"""
+Keep-alive HTTP/1.1 client pool on asyncio streams. aio is the asyncio
+module or coroutine_asyncio, so the same client runs on asyncio, uvloop and
+coroutine.Scheduler.
+"""
+import time
+import httppool
+from httpparser import ParseError, ResponseParser
+
+class Connection:
+    def __init__(self, host, port, pool, loop):
+        self.pool = pool
+        self.reader = None
+        self.writer = None
+        self.parser = None
+        self.host = host
+        self.port = port
+        self.loop = loop
+
+        # Closed takes no new requests, retired has been replaced in the
+        # pool.
+        self.closed = False
+        self.retired = False
+        # The server closed the connection or said it would, seen as a
+        # read returning b'', a Connection: close response or by peeking at
+        # an idle connection.
+        self.eof = False
+        self.requests = 0
+        self.last_used = time.monotonic()
+
+    async def connect(self):
+        start = time.monotonic()
+
+        try:
+            self.reader, self.writer = await self.pool.aio.open_connection(self.host, self.port)
+        except OSError:
+            self.pool.failures += 1
+            raise
+
+        self.parser = ResponseParser(keep_body=False)
+        self.pool.connected(time.monotonic() - start)
+
+    async def read_response(self, num_bytes):
+        """
+        Read until the next response is complete and return it, or None if
+        the connection closed first.
+        """
+        if not self.reader:
+            await self.connect()
+
+        while True:
+            response = self.parser.next(head=self.pool.head)
+            if response:
+                if response.header(b'connection', b'').lower() == b'close':
+                    self.eof = True
+                return response
+
+            data = await self.reader.read(num_bytes)
+            if not data:
+                self.eof = True
+                try:
+                    return self.parser.eof()
+                except ParseError:
+                    return None
+
+            self.parser.feed(data)
+
+    async def send(self, message):
+        if not self.writer:
+            await self.connect()
+
+        self.requests += 1
+        self.pool.requests += 1
+        self.writer.write(message)
+
+    async def request(self, message):
+        await self.send(message)
+        return await self.read_response(65535)
+
+    def healthy(self, idle=False):
+        """
+        Whether the connection can take another request: it is still open
+        (including never opened), under max_requests and not idle for longer
+        than idle_ttl.
+
+        idle is true for a connection coming off the idle stack, the only
+        time the server may have closed it unseen. Only then is at_eof()
+        asked, since coroutine_asyncio answers it with a recv(MSG_PEEK).
+        """
+        if idle and self.reader and not self.eof:
+            self.eof = self.reader.at_eof()
+
+        if self.closed or self.eof:
+            return False
+
+        if self.pool.max_requests and self.requests >= self.pool.max_requests:
+            return False
+
+        return not self.pool.idle_ttl or time.monotonic() - self.last_used < self.pool.idle_ttl
+
+    def release(self):
+        self.pool.release(self)
+
+    def close(self):
+        if self.writer:
+            self.writer.close()
+
+        self.closed = True
+        self.writer = None
+        self.reader = None
+        self.parser = None
+
+class Pool(httppool.Pool):
+    def new_connection(self):
+        return Connection(self.host, self.port, self, self.loop)
@@ -0,0 +1,10 @@
+#!/usr/bin/python3
+"""
+The streams client on coroutine.Scheduler, over a sweep of connection
+limits. See loadgen.py, any of its options can be passed to override these.
+"""
+import sys
+import loadgen
+
+if __name__ == '__main__':
+    sys.exit(loadgen.main(['--backends', 'scheduler', '--connections', '10,100,1000'] + sys.argv[1:]))
@@ -0,0 +1,238 @@
+class ParseError(ValueError):
+    """
+    Raised for a response that isn't valid HTTP/1.x.
+    """
+
+class Response:
+    def __init__(self, version, status, reason, headers):
+        self.version = version
+        self.status = status
+        self.reason = reason
+        # List of (lowercase name, value) byte strings, in order.
+        self.headers = headers
+        # A bytearray if the parser keeps bodies, otherwise None.
+        self.body = None
+        self.body_length = 0
+        # Bytes the response took on the wire, headers and chunk framing
+        # included.
+        self.size = 0
+
+    def header(self, name, default=None):
+        name = name.lower()
+
+        for key, value in self.headers:
+            if key == name:
+                return value
+
+        return default
+
+    def __repr__(self):
+        return '<Response %s %d %s, %d byte body>' % (
+            self.version.decode('latin-1'), self.status, self.reason.decode('latin-1'), self.body_length)
+
+class ResponseParser:
+    """
+    Incremental HTTP/1.x response parser. feed() it whatever arrives on the
+    connection and call next() for each response expected, in request order.
+    Bodies are framed by Content-Length, chunked encoding or the connection
+    closing (see eof()).
+
+    Data is appended to one bytearray and consumed by moving an offset, the
+    buffer is only compacted once the consumed prefix gets large. With
+    keep_body=False body bytes are counted and dropped as they arrive, so a
+    benchmark client never copies or holds onto bodies.
+    """
+    HEADERS, BODY, CHUNK_SIZE, CHUNK_DATA, CHUNK_END, TRAILERS, UNTIL_CLOSE = range(7)
+
+    def __init__(self, keep_body=True, max_header_size=65536):
+        self.keep_body = keep_body
+        self.max_header_size = max_header_size
+
+        self.buffer = bytearray()
+        self.offset = 0
+        # Stream position of buffer[0] and of the current response's first
+        # byte, to size responses across compactions.
+        self.position = 0
+        self.start = 0
+        # Where to resume looking for the end of the headers.
+        self.scanned = 0
+
+        self.state = self.HEADERS
+        self.response = None
+        self.remaining = 0
+        # Set after a 1xx interim response, until the final one is done.
+        self.interim = False
+
+    def feed(self, data):
+        if self.offset == len(self.buffer):
+            self.position += self.offset
+            del self.buffer[:]
+            self.offset = self.scanned = 0
+        elif self.offset > 65536:
+            self.position += self.offset
+            del self.buffer[:self.offset]
+            self.scanned -= self.offset
+            self.offset = 0
+
+        self.buffer += data
+
+    def next(self, head=False):
+        """
+        Return the next complete Response, or None if more data is needed.
+        head is true when the response is to a HEAD request, so it has no
+        body whatever its headers say.
+        """
+        while True:
+            state = self.state
+
+            if state == self.HEADERS:
+                if not self.parse_headers(head):
+                    return None
+
+                # 100 Continue and 103 Early Hints come ahead of the final
+                # response to the same request, 101 is the last response
+                # on the connection.
+                status = self.response.status
+                if status < 200 and status != 101:
+                    self.interim = True
+                    self.response = None
+                    self.state = self.HEADERS
+            elif state == self.BODY or state == self.CHUNK_DATA or state == self.UNTIL_CLOSE:
+                available = len(self.buffer) - self.offset
+                if state == self.UNTIL_CLOSE:
+                    count = available
+                else:
+                    count = min(self.remaining, available)
+
+                self.consume_body(count)
+                self.remaining -= count
+
+                if state == self.UNTIL_CLOSE or self.remaining:
+                    return None
+
+                if state == self.BODY:
+                    return self.finish()
+                self.state = self.CHUNK_END
+            elif state == self.CHUNK_END:
+                if len(self.buffer) - self.offset < 2:
+                    return None
+                if self.buffer[self.offset:self.offset + 2] != b'\r\n':
+                    raise ParseError('missing CRLF after chunk')
+
+                self.offset += 2
+                self.state = self.CHUNK_SIZE
+            else:
+                line = self.readline()
+                if line is None:
+                    return None
+
+                if state == self.TRAILERS:
+                    if not line:
+                        return self.finish()
+                    continue
+
+                try:
+                    size = int(line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise ParseError('invalid chunk size %r' % line)
+
+                if size:
+                    self.remaining = size
+                    self.state = self.CHUNK_DATA
+                else:
+                    self.state = self.TRAILERS
+
+    def eof(self):
+        """
+        The connection closed. Return the response whose body ran until the
+        close, or None if no response was in progress.
+        """
+        if self.state == self.UNTIL_CLOSE:
+            return self.finish()
+
+        if self.state != self.HEADERS or self.offset < len(self.buffer):
+            raise ParseError('connection closed in the middle of a response')
+
+        return None
+
+    def parse_headers(self, head):
+        end = self.buffer.find(b'\r\n\r\n', max(self.scanned, self.offset))
+        if end < 0:
+            if len(self.buffer) - self.offset > self.max_header_size:
+                raise ParseError('headers larger than %d bytes' % self.max_header_size)
+
+            # The terminator might straddle the next read.
+            self.scanned = max(len(self.buffer) - 3, self.offset)
+            return False
+
+        lines = bytes(self.buffer[self.offset:end]).split(b'\r\n')
+        # Interim responses count towards the size of the final one.
+        if not self.interim:
+            self.start = self.position + self.offset
+        self.offset = end + 4
+        self.scanned = self.offset
+
+        parts = lines[0].split(b' ', 2)
+        if len(parts) < 2 or not parts[0].startswith(b'HTTP/'):
+            raise ParseError('invalid status line %r' % lines[0])
+
+        try:
+            status = int(parts[1])
+        except ValueError:
+            raise ParseError('invalid status code %r' % parts[1])
+
+        headers = []
+        for line in lines[1:]:
+            name, colon, value = line.partition(b':')
+            if not colon:
+                raise ParseError('invalid header %r' % line)
+            headers.append((name.strip().lower(), value.strip()))
+
+        self.response = Response(parts[0], status, parts[2] if len(parts) > 2 else b'', headers)
+        if self.keep_body:
+            self.response.body = bytearray()
+
+        transfer_encoding = self.response.header(b'transfer-encoding', b'')
+        content_length = self.response.header(b'content-length')
+
+        # Responses to HEAD, 1xx, 204 and 304 never have a body.
+        if head or status < 200 or status in (204, 304):
+            self.remaining = 0
+            self.state = self.BODY
+        elif b'chunked' in transfer_encoding.lower():
+            self.state = self.CHUNK_SIZE
+        elif content_length is not None:
+            try:
+                self.remaining = int(content_length)
+            except ValueError:
+                raise ParseError('invalid Content-Length %r' % content_length)
+            self.state = self.BODY
+        else:
+            self.state = self.UNTIL_CLOSE
+
+        return True
+
+    def readline(self):
+        end = self.buffer.find(b'\r\n', self.offset)
+        if end < 0:
+            return None
+
+        line = bytes(self.buffer[self.offset:end])
+        self.offset = end + 2
+        return line
+
+    def consume_body(self, count):
+        if self.keep_body and count:
+            self.response.body += memoryview(self.buffer)[self.offset:self.offset + count]
+
+        self.offset += count
+        self.response.body_length += count
+
+    def finish(self):
+        response = self.response
+        response.size = self.position + self.offset - self.start
+        self.response = None
+        self.state = self.HEADERS
+        self.scanned = self.offset
+        self.interim = False
+        return response
@@ -0,0 +1,169 @@
+"""
+Keep-alive connection pool shared by the http_streams and http_protocol
+clients. Subclasses say how a connection is created, and how it is dropped
+once retired.
+"""
+import collections
+import time
+from histogram import Histogram
+
+class Pool:
+    """
+    Up to depth requests share a connection, so the idle stack holds one
+    entry per free slot on a connection. It is LIFO, so the most recently
+    used (warmest) connection is handed out first. When every slot is busy
+    the caller waits on a FIFO of futures and release() hands its slot
+    straight to the oldest waiter. Both are O(1) and need no lock, since the
+    loop is single threaded.
+
+    A connection that the server closes, or that reaches max_requests or
+    idle_ttl, is retired: its slots are dropped as they come back and a
+    replacement is connected in the background so requests don't wait on
+    the handshake.
+
+    aio is the asyncio module or coroutine_asyncio.
+    """
+    depth = 1
+
+    def __init__(self, aio, host, port, conn_limit, loop, head=True, max_requests=0, idle_ttl=0):
+        self.aio = aio
+        self.conn_limit = conn_limit
+
+        self.host = host
+        self.port = port
+
+        self.loop = loop
+
+        # Responses to HEAD have no body, whatever their headers say.
+        self.head = head
+        # Retire a connection after this many requests or seconds idle, 0
+        # disables.
+        self.max_requests = max_requests
+        self.idle_ttl = idle_ttl
+
+        self.pool = set()
+        self.idle = []
+        self.waiters = collections.deque()
+        self.replacing = set()
+        self.closing = False
+
+        self.requests = 0
+        self.connects = 0
+        self.connect_times = Histogram()
+        # Connections the server closed, connections retired by
+        # max_requests or idle_ttl, and failed connects.
+        self.closed = 0
+        self.retired = 0
+        self.failures = 0
+
+    def new_connection(self):
+        raise NotImplementedError
+
+    def drop(self, connection):
+        """
+        Close a retired connection.
+        """
+        connection.close()
+
+    async def connect(self):
+        while self.idle:
+            connection = self.idle.pop()
+            if connection.healthy(idle=True):
+                return connection
+
+            self.retire(connection)
+
+        if len(self.pool) < self.conn_limit:
+            connection = self.new_connection()
+            self.pool.add(connection)
+            self.idle.extend([connection] * (self.depth - 1))
+            return connection
+
+        waiter = self.loop.create_future()
+        self.waiters.append(waiter)
+        return await waiter
+
+    async def request(self, message):
+        """
+        Send message (bytes) on a pooled connection and return the Response,
+        or None if the connection closed before it arrived. The slot is held
+        until the response arrives.
+        """
+        connection = await self.connect()
+
+        try:
+            response = await connection.request(message)
+        except Exception:
+            connection.close()
+            connection.release()
+            raise
+
+        connection.release()
+        return response
+
+    def release(self, connection):
+        connection.last_used = time.monotonic()
+
+        if not connection.healthy():
+            self.retire(connection)
+            return
+
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(connection)
+                return
+
+        self.idle.append(connection)
+
+    def connected(self, elapsed):
+        self.connects += 1
+        self.connect_times.record(int(elapsed * 1e9))
+
+    def retire(self, connection):
+        if connection.retired or self.closing:
+            return
+
+        connection.retired = True
+        if connection.eof:
+            self.closed += 1
+        elif not connection.closed:
+            self.retired += 1
+        self.drop(connection)
+
+        self.pool.discard(connection)
+
+        replacement = self.new_connection()
+        self.pool.add(replacement)
+
+        task = self.loop.create_task(self.replace(replacement))
+        self.replacing.add(task)
+        task.add_done_callback(self.replacing.discard)
+
+    async def replace(self, connection):
+        try:
+            await connection.connect()
+        except OSError:
+            # Counted as a failure, the first request retries the connect.
+            pass
+
+        for _ in range(self.depth):
+            self.release(connection)
+
+    async def close(self):
+        if self.replacing:
+            await self.aio.wait(list(self.replacing))
+
+        self.closing = True
+        for connection in self.pool:
+            connection.close()
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'connects': self.connects,
+            'connect_times': self.connect_times.to_dict(),
+            'closed': self.closed,
+            'retired': self.retired,
+            'failures': self.failures,
+        }
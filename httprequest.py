@@ -0,0 +1,43 @@
+"""
+HTTP/1.1 requests compiled to bytes once, so a benchmark client doesn't
+format and encode the same request for every send.
+"""
+
+class RequestTemplate:
+    """
+    A request with a fixed method, path and headers, plus optional header
+    slots whose values are filled in per request:
+
+        template = RequestTemplate('GET', '/', '127.0.0.1', slots=['X-Request-Id'])
+        template.render(b'42')
+
+    Without slots every request is the same bytes, render() just returns
+    them.
+    """
+    def __init__(self, method, path, host, headers=(), slots=()):
+        lines = ['%s %s HTTP/1.1' % (method, path), 'Host: %s' % host]
+        lines.extend('%s: %s' % header for header in headers)
+
+        for line in lines:
+            if '\r' in line or '\n' in line:
+                raise ValueError('Line break in request line or header %r.' % line)
+
+        self.prefix = ''.join(line + '\r\n' for line in lines).encode('latin-1')
+        self.slots = [('%s: ' % name).encode('latin-1') for name in slots]
+        self.request = None if self.slots else self.prefix + b'\r\n'
+
+    def render(self, *values):
+        if self.request is not None:
+            return self.request
+
+        if len(values) != len(self.slots):
+            raise ValueError('Expected %d header values, got %d.' % (len(self.slots), len(values)))
+
+        parts = [self.prefix]
+        for name, value in zip(self.slots, values):
+            if isinstance(value, str):
+                value = value.encode('latin-1')
+            parts.extend((name, value, b'\r\n'))
+        parts.append(b'\r\n')
+
+        return b''.join(parts)
@@ -0,0 +1,309 @@
+#!/usr/bin/python3
+"""
+A stand-in HTTP/1.1 server for the client benchmarks, so results don't
+depend on whatever happens to be listening on port 80. Response size,
+latency, keep-alive, chunked encoding and error rate are configurable.
+
+    with Server(processes=2, size=1024, latency='exp:5') as server:
+        loadgen.main([server.url])
+
+The listening socket is bound in the parent (port 0 picks a free one) and
+shared by the worker processes, each running asyncio protocols on asyncio
+or uvloop.
+"""
+import argparse
+import asyncio
+import collections
+import multiprocessing
+import random
+import socket
+import sys
+
+def parse_latency(spec):
+    """
+    Parse a latency distribution in milliseconds: fixed:MS, uniform:MIN,MAX,
+    exp:MEAN or normal:MEAN,STDDEV. Return a function of a Random returning
+    a delay in seconds, or None for no delay.
+    """
+    if not spec or spec in ('0', 'none'):
+        return None
+
+    kind, _, params = spec.partition(':')
+    try:
+        values = [float(value) / 1000 for value in params.split(',')]
+    except ValueError:
+        raise ValueError('Invalid latency parameters %r.' % spec)
+
+    distributions = {
+        'fixed': (1, lambda rng: values[0]),
+        'uniform': (2, lambda rng: rng.uniform(values[0], values[1])),
+        'exp': (1, lambda rng: rng.expovariate(1 / values[0]) if values[0] else 0),
+        'normal': (2, lambda rng: max(rng.gauss(values[0], values[1]), 0)),
+    }
+
+    if kind not in distributions:
+        raise ValueError('Unknown latency distribution %r, choose from %s.' % (kind, ', '.join(sorted(distributions))))
+
+    count, distribution = distributions[kind]
+    if len(values) != count:
+        raise ValueError('%s latency takes %d parameters, got %r.' % (kind, count, params))
+
+    return distribution
+
+class Behaviour:
+    """
+    How the server responds. size is the body length, close_every closes
+    the connection after that many responses (0 keeps it alive), error_rate
+    is the fraction of requests answered with a 503. Responses are built
+    once per kind and reused.
+    """
+    def __init__(self, size=0, latency=None, close_every=0, chunked=False, chunk_size=4096, error_rate=0.0):
+        self.size = size
+        self.latency = parse_latency(latency)
+        self.close_every = close_every
+        self.chunked = chunked
+        self.chunk_size = chunk_size
+        self.error_rate = error_rate
+
+        self.responses = {}
+
+    def delay(self, rng):
+        return self.latency(rng) if self.latency else 0
+
+    def response(self, rng, head, close):
+        error = bool(self.error_rate) and rng.random() < self.error_rate
+        key = (head, close, error)
+
+        response = self.responses.get(key)
+        if response is None:
+            response = self.responses[key] = self.build(head, close, error)
+
+        return response
+
+    def build(self, head, close, error):
+        if error:
+            headers = [b'HTTP/1.1 503 Service Unavailable', b'Content-Length: 0']
+            body = b''
+        elif self.chunked:
+            headers = [b'HTTP/1.1 200 OK', b'Transfer-Encoding: chunked']
+            chunks = [b'x' * min(self.chunk_size, self.size - offset) for offset in range(0, self.size, self.chunk_size)]
+            body = b''.join(b'%x\r\n%s\r\n' % (len(chunk), chunk) for chunk in chunks) + b'0\r\n\r\n'
+        else:
+            headers = [b'HTTP/1.1 200 OK', b'Content-Length: %d' % self.size]
+            body = b'x' * self.size
+
+        headers.append(b'Server: bencher')
+        if close:
+            headers.append(b'Connection: close')
+
+        return b'\r\n'.join(headers) + b'\r\n\r\n' + (b'' if head else body)
+
+class HTTPServerProtocol(asyncio.Protocol):
+    def __init__(self, behaviour, loop, rng):
+        self.behaviour = behaviour
+        self.loop = loop
+        self.rng = rng
+
+        self.transport = None
+        self.buffer = bytearray()
+        self.requests = 0
+        # Set once a response closes the connection, later requests are
+        # ignored.
+        self.closing = False
+        # [response, close] for requests still waiting out their latency.
+        # Responses go out in request order, so a quick response waits for
+        # a slow one pipelined ahead of it.
+        self.queue = collections.deque()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+
+    def data_received(self, data):
+        self.buffer += data
+
+        while not self.closing:
+            end = self.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(self.buffer) > 65536:
+                    self.transport.close()
+                    self.closing = True
+                break
+
+            lines = bytes(self.buffer[:end]).lower().split(b'\r\n')
+
+            length = 0
+            close = False
+            for line in lines[1:]:
+                name, _, value = line.partition(b':')
+                if name == b'content-length':
+                    try:
+                        length = int(value)
+                    except ValueError:
+                        length = -1
+                elif name == b'connection':
+                    close = value.strip() == b'close'
+
+            if length < 0:
+                self.transport.close()
+                self.closing = True
+                break
+
+            if len(self.buffer) < end + 4 + length:
+                break
+            del self.buffer[:end + 4 + length]
+
+            self.requests += 1
+            if self.behaviour.close_every and self.requests % self.behaviour.close_every == 0:
+                close = True
+
+            self.respond(lines[0].startswith(b'head '), close)
+            self.closing = close
+
+    def respond(self, head, close):
+        response = self.behaviour.response(self.rng, head, close)
+        delay = self.behaviour.delay(self.rng)
+
+        if not delay and not self.queue:
+            self.write(response, close)
+            return
+
+        entry = [None, close]
+        self.queue.append(entry)
+        self.loop.call_later(delay, self.ready, entry, response)
+
+    def ready(self, entry, response):
+        entry[0] = response
+
+        while self.queue and self.queue[0][0] is not None:
+            response, close = self.queue.popleft()
+            self.write(response, close)
+
+    def write(self, response, close):
+        if self.transport is None:
+            return
+
+        self.transport.write(response)
+        if close:
+            self.transport.close()
+            self.transport = None
+
+def new_loop(name):
+    if name == 'uvloop':
+        import uvloop
+        return uvloop.new_event_loop()
+
+    return asyncio.new_event_loop()
+
+def serve(sock, behaviour, loop_name, seed):
+    loop = new_loop(loop_name)
+    asyncio.set_event_loop(loop)
+    rng = random.Random(seed)
+
+    loop.run_until_complete(loop.create_server(lambda: HTTPServerProtocol(behaviour, loop, rng), sock=sock))
+    loop.run_forever()
+
+class Server:
+    """
+    Serve from processes worker processes until stop(). Behaviour options
+    (size, latency, close_every, chunked, chunk_size, error_rate) are passed
+    through as keyword arguments.
+    """
+    def __init__(self, host='127.0.0.1', port=0, processes=1, loop='asyncio', seed=None, **options):
+        self.host = host
+        self.port = port
+        self.processes = processes
+        self.loop = loop
+        self.seed = seed
+        self.behaviour = Behaviour(**options)
+
+        self.sock = None
+        self.procs = []
+
+    @property
+    def url(self):
+        return 'http://%s:%d/' % (self.host, self.port)
+
+    def start(self):
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]
+
+        for i in range(self.processes):
+            seed = None if self.seed is None else self.seed + i
+            proc = multiprocessing.Process(target=serve, args=(self.sock, self.behaviour, self.loop, seed), daemon=True)
+            proc.start()
+            self.procs.append(proc)
+
+        return self
+
+    def stop(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            proc.join()
+
+        self.procs = []
+        self.sock.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+def add_arguments(parser):
+    """
+    Add the Behaviour options to an argparse parser.
+    """
+    parser.add_argument('--size', type=int, default=0, help='response body size in bytes (default: %(default)s)')
+    parser.add_argument('--latency', help='response latency in ms: fixed:MS, uniform:MIN,MAX, exp:MEAN or normal:MEAN,STDDEV')
+    parser.add_argument('--close-every', type=int, default=0,
+        help='close connections after this many responses, 0 keeps them alive (default: %(default)s)')
+    parser.add_argument('--chunked', action='store_true', help='send bodies with chunked encoding')
+    parser.add_argument('--chunk-size', type=int, default=4096, help='bytes per chunk (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with a 503')
+
+def behaviour_options(args):
+    return {
+        'size': args.size,
+        'latency': args.latency,
+        'close_every': args.close_every,
+        'chunked': args.chunked,
+        'chunk_size': args.chunk_size,
+        'error_rate': args.error_rate,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stand-in HTTP server for the client benchmarks.')
+    parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=0, help='port to listen on, 0 picks a free one (default: %(default)s)')
+    parser.add_argument('-p', '--processes', type=int, default=1, help='worker processes (default: %(default)s)')
+    parser.add_argument('--loop', default='asyncio', choices=('asyncio', 'uvloop'), help='event loop (default: %(default)s)')
+    parser.add_argument('--seed', type=int, help='seed for latency and errors, for repeatable runs')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    try:
+        server = Server(args.host, args.port, args.processes, args.loop, args.seed, **behaviour_options(args))
+    except ValueError as e:
+        parser.error(str(e))
+
+    with server:
+        print('Serving on %s with %d processes.' % (server.url, args.processes))
+        sys.stdout.flush()
+
+        try:
+            for proc in server.procs:
+                proc.join()
+        except KeyboardInterrupt:
+            pass
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
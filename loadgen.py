@@ -0,0 +1,796 @@
+#!/usr/bin/python3
+"""
+HTTP load generator with pluggable client backends, so aiohttp, the custom
+streams and protocol pools, coroutine.Scheduler and gevent can be compared
+against the same server with the same workload and report.
+
+    ./loadgen.py http://127.0.0.1/ --backends streams,protocol --loops asyncio,uvloop \\
+        --connections 10,100 --depths 1,8 --duration 10
+
+Every combination of backend, loop, connection limit, pipeline depth and
+rate is benchmarked in turn and printed as one row of a table.
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from urllib.parse import urlsplit
+import httpserver
+from histogram import Histogram
+from httprequest import RequestTemplate
+from resultstore import ResultStore
+from stats import confidence_interval
+
+class Budget:
+    """
+    The requests every client process draws from: a fixed count, or as many
+    as fit before a deadline, optionally at a global rate.
+
+    The count and the rate schedule live in shared memory. Each process
+    claims a batch at a time under a lock, so a fast process simply claims
+    more batches than a slow one and nobody idles while work is left. With
+    a rate, a batch is a run of consecutive send slots on the one global
+    schedule, so the processes together never run ahead of it.
+
+    The clock starts once all processes are ready to send (see start()), so
+    forking and setting up the client isn't charged as latency or eaten out
+    of the duration.
+    """
+    # Seconds start() waits for the other processes, in case one died
+    # without reaching it.
+    timeout = 60
+
+    def __init__(self, count=None, duration=None, rate=0, batch=100, processes=1):
+        self.count = count
+        self.duration = duration
+        self.interval = 1.0 / rate if rate else 0
+        # A batch of slots covers at most 10ms of the schedule, so a
+        # stalled process holds up little of it.
+        self.batch = max(min(batch, int(rate / 100)), 1) if rate else batch
+
+        self.barrier = multiprocessing.Barrier(processes)
+        self.lock = multiprocessing.Lock()
+        self.origin = multiprocessing.RawValue('d', 0.0)
+        self.issued = multiprocessing.RawValue('q', 0)
+        self.next_slot = multiprocessing.RawValue('d', 0.0)
+        self.deadline = None
+        # Wall clock time this process started sending.
+        self.started = None
+
+        # This process's unused claim.
+        self.remaining = 0
+        self.slot = 0.0
+
+    def start(self):
+        """
+        Wait until every process is ready to send. The first one through
+        starts the clock that the rate schedule and deadline run from.
+        """
+        self.barrier.wait(self.timeout)
+
+        with self.lock:
+            if not self.origin.value:
+                self.origin.value = self.next_slot.value = time.monotonic()
+
+        if self.duration:
+            self.deadline = self.origin.value + self.duration
+        self.started = time.time()
+
+    def abort(self):
+        """
+        This process failed, so release the others from start().
+        """
+        self.barrier.abort()
+
+    def claim(self):
+        with self.lock:
+            count = self.batch
+            if self.count is not None:
+                count = min(count, self.count - self.issued.value)
+            self.issued.value += count
+
+            slot = self.next_slot.value
+            self.next_slot.value += count * self.interval
+
+        self.remaining = count
+        self.slot = slot
+
+    def take(self):
+        """
+        Return when the next request is due (now, without a rate), or None
+        once the budget is spent.
+        """
+        if not self.remaining:
+            self.claim()
+            if not self.remaining:
+                return None
+
+        self.remaining -= 1
+
+        if self.interval:
+            due = self.slot
+            self.slot += self.interval
+        else:
+            due = time.monotonic()
+
+        if self.deadline is not None and due >= self.deadline:
+            self.remaining = 0
+            return None
+
+        return due
+
+class Recorder:
+    """
+    Latency of completed requests, counts of failed ones by reason and the
+    bytes received. Any response short of a 5xx completes the request, the
+    ones other than a 2xx are counted by status as well.
+    """
+    def __init__(self):
+        self.histogram = Histogram()
+        self.completed = 0
+        self.failed = 0
+        self.errors = collections.Counter()
+        self.statuses = collections.Counter()
+        self.bytes = 0
+
+    def record(self, status, size, latency):
+        """
+        status is the response's status code, or None if the connection
+        closed before the response arrived, and size its length in bytes.
+        """
+        self.bytes += size
+
+        if status and status < 500:
+            self.completed += 1
+            self.histogram.record(int(latency * 1e9))
+            if not 200 <= status < 300:
+                self.statuses['HTTP %d' % status] += 1
+        else:
+            self.failed += 1
+            self.errors['HTTP %d' % status if status else 'closed'] += 1
+
+    def error(self, e):
+        self.failed += 1
+        self.errors[type(e).__name__] += 1
+
+    def to_dict(self):
+        return {
+            'completed': self.completed,
+            'failed': self.failed,
+            'errors': dict(self.errors),
+            'statuses': dict(self.statuses),
+            'bytes': self.bytes,
+            'histogram': self.histogram.to_dict(),
+        }
+
+class Target:
+    """
+    The request to send. The custom clients get it as bytes compiled once
+    by RequestTemplate, the library backends as method, URL and headers.
+    id_header, if set, is a header numbering the requests of each process.
+    """
+    def __init__(self, url, method, headers=(), id_header=None):
+        parts = urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError('Only http:// URLs are supported, not %r.' % url)
+
+        self.url = url
+        self.method = method
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or '/'
+        if parts.query:
+            self.path += '?' + parts.query
+
+        self.headers = [('User-Agent', 'fast-af')] + list(headers)
+        self.id_header = id_header
+        self.ids = itertools.count(1)
+
+        self.template = RequestTemplate(method, self.path, parts.netloc, self.headers,
+            slots=[id_header] if id_header else ())
+
+    def message(self):
+        if self.id_header:
+            return self.template.render(str(next(self.ids)))
+
+        return self.template.request
+
+    def header_dict(self):
+        headers = dict(self.headers)
+        if self.id_header:
+            headers[self.id_header] = str(next(self.ids))
+
+        return headers
+
+def header_size(headers):
+    """
+    Approximate the wire size of a parsed response's headers, for clients
+    that don't expose the raw bytes. The status line isn't counted.
+    """
+    return sum(len(name) + len(value) + 4 for name, value in headers) + 2
+
+async def timed(request, recorder, start):
+    try:
+        status, size = await request()
+    except Exception as e:
+        recorder.error(e)
+        return
+
+    recorder.record(status, size, time.monotonic() - start)
+
+async def closed_loop(aio, request, recorder, budget, concurrency):
+    """
+    concurrency workers each send their next request as soon as the last
+    one completes.
+    """
+    async def worker():
+        while budget.take() is not None:
+            await timed(request, recorder, time.monotonic())
+
+    await aio.wait([aio.ensure_future(worker()) for _ in range(concurrency)])
+
+async def open_loop(aio, request, recorder, budget):
+    """
+    Start requests when budget says they are due, regardless of how many are still waiting
+    for a response. Latency is measured from when the request should have
+    been sent, so time spent queued behind a slow server counts, and
+    requests that are due after a late wakeup are started in a burst.
+    """
+    pending = set()
+
+    while True:
+        intended = budget.take()
+        if intended is None:
+            break
+
+        delay = intended - time.monotonic()
+        if delay > 0:
+            await aio.sleep(delay)
+
+        task = aio.ensure_future(timed(request, recorder, intended))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+
+    if pending:
+        await aio.wait(list(pending))
+
+class Backend:
+    """
+    A client library. run() sets up the client, calls budget.start(), sends
+    the requests budget allows to target and returns the Recorder's dict,
+    plus the pool's stats if it keeps any.
+    """
+    name = None
+    # Event loops the backend can run on, the first is the default.
+    loops = ()
+    pipelines = False
+    # Always run in a client process, even with --processes 1, for
+    # backends that leave the process changed.
+    isolated = False
+
+    def run(self, target, args, point, budget):
+        raise NotImplementedError()
+
+class AsyncBackend(Backend):
+    loops = ('asyncio', 'uvloop')
+    aio = asyncio
+
+    def new_loop(self, name):
+        if name == 'uvloop':
+            import uvloop
+            loop = uvloop.new_event_loop()
+        else:
+            loop = asyncio.new_event_loop()
+
+        asyncio.set_event_loop(loop)
+        return loop
+
+    def run(self, target, args, point, budget):
+        loop = self.new_loop(point['loop'])
+
+        try:
+            return loop.run_until_complete(self.main(loop, target, args, point, budget))
+        finally:
+            loop.close()
+
+    async def main(self, loop, target, args, point, budget):
+        session = await self.open(loop, target, args, point)
+        recorder = Recorder()
+        budget.start()
+
+        async def request():
+            return await self.request(session, target)
+
+        try:
+            if point['rate']:
+                await open_loop(self.aio, request, recorder, budget)
+            else:
+                await closed_loop(self.aio, request, recorder, budget, args.concurrency)
+        finally:
+            stats = await self.close(session)
+
+        result = recorder.to_dict()
+        result['pool'] = stats
+        return result
+
+class StreamsBackend(AsyncBackend):
+    name = 'streams'
+
+    async def open(self, loop, target, args, point):
+        import http_streams
+        return http_streams.Pool(self.aio, target.host, target.port, point['connections'], loop,
+            head=target.method == 'HEAD', max_requests=args.max_requests, idle_ttl=args.idle_ttl)
+
+    async def request(self, pool, target):
+        response = await pool.request(target.message())
+        if response is None:
+            return None, 0
+
+        return response.status, response.size
+
+    async def close(self, pool):
+        await pool.close()
+        return pool.stats()
+
+class SchedulerBackend(StreamsBackend):
+    """
+    The streams client on coroutine.Scheduler, through coroutine_asyncio.
+    """
+    name = 'scheduler'
+    loops = ('scheduler',)
+
+    def __init__(self):
+        import coroutine_asyncio
+        self.aio = coroutine_asyncio
+
+    def new_loop(self, name):
+        return self.aio.new_event_loop()
+
+class ProtocolBackend(StreamsBackend):
+    name = 'protocol'
+    pipelines = True
+
+    async def open(self, loop, target, args, point):
+        import http_protocol
+        return http_protocol.Pool(target.host, target.port, point['connections'], loop, depth=point['depth'],
+            head=target.method == 'HEAD', max_requests=args.max_requests, idle_ttl=args.idle_ttl)
+
+class AiohttpBackend(AsyncBackend):
+    name = 'aiohttp'
+
+    async def open(self, loop, target, args, point):
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=point['connections'])
+        return aiohttp.ClientSession(connector=connector)
+
+    async def request(self, session, target):
+        async with session.request(target.method, target.url, headers=target.header_dict()) as response:
+            body = await response.read()
+            return response.status, header_size(response.raw_headers) + len(body)
+
+    async def close(self, session):
+        await session.close()
+        return None
+
+class GeventBackend(Backend):
+    """
+    requests on gevent greenlets. The process is monkey patched when the
+    backend runs, so it never runs in the parent.
+    """
+    name = 'gevent'
+    loops = ('gevent',)
+    isolated = True
+
+    def run(self, target, args, point, budget):
+        from gevent import monkey
+        monkey.patch_all()
+
+        import gevent
+        import gevent.pool
+        import requests
+
+        session = requests.Session()
+        session.mount('http://', requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=point['connections'], pool_block=True))
+        recorder = Recorder()
+        budget.start()
+
+        def timed(start):
+            try:
+                response = session.request(target.method, target.url, headers=target.header_dict())
+            except Exception as e:
+                recorder.error(e)
+                return
+
+            size = header_size(response.headers.items()) + len(response.content)
+            recorder.record(response.status_code, size, time.monotonic() - start)
+
+        if point['rate']:
+            group = gevent.pool.Group()
+
+            while True:
+                intended = budget.take()
+                if intended is None:
+                    break
+
+                delay = intended - time.monotonic()
+                if delay > 0:
+                    gevent.sleep(delay)
+
+                group.spawn(timed, intended)
+
+            group.join()
+        else:
+            def worker():
+                while budget.take() is not None:
+                    timed(time.monotonic())
+
+            pool = gevent.pool.Pool(args.concurrency)
+            for _ in range(args.concurrency):
+                pool.spawn(worker)
+            pool.join()
+
+        session.close()
+        result = recorder.to_dict()
+        result['pool'] = None
+        return result
+
+BACKENDS = dict((backend.name, backend) for backend in (
+    AiohttpBackend, StreamsBackend, ProtocolBackend, SchedulerBackend, GeventBackend))
+
+class BenchmarkError(Exception):
+    """
+    A client process failed, the message is its traceback.
+    """
+
+def run(name, target, args, point, budget):
+    """
+    Run a benchmark point in this process until budget is spent. The wall
+    clock start and finish are kept so results from several processes can
+    be lined up.
+    """
+    result = BACKENDS[name]().run(target, args, point, budget)
+    result['started'] = budget.started
+    result['finished'] = time.time()
+    return result
+
+def attempt(name, target, args, point, budget):
+    """
+    run(), returning {'error': traceback} instead of raising if it fails.
+    """
+    try:
+        return run(name, target, args, point, budget)
+    except Exception:
+        budget.abort()
+        return {'error': traceback.format_exc()}
+
+def child(writer, name, target, args, point, budget):
+    """
+    attempt() in a client process and send the result to the parent.
+    """
+    writer.send(attempt(name, target, args, point, budget))
+    writer.close()
+
+def merge(results):
+    """
+    Add up the results of every process. Throughput is measured over the
+    window from the first process starting to the last one finishing, so a
+    straggler lowers it rather than being averaged away.
+    """
+    total = {
+        'completed': 0,
+        'failed': 0,
+        'errors': collections.Counter(),
+        'statuses': collections.Counter(),
+        'bytes': 0,
+        'elapsed': max(result['finished'] for result in results) - min(result['started'] for result in results),
+        # The slowest and fastest process, to see how the work spread.
+        'process_rps': [result['completed'] / (result['finished'] - result['started']) for result in results],
+    }
+    histogram = Histogram()
+    pool = None
+
+    for result in results:
+        total['completed'] += result['completed']
+        total['failed'] += result['failed']
+        total['errors'].update(result['errors'])
+        total['statuses'].update(result['statuses'])
+        total['bytes'] += result['bytes']
+        histogram.merge(Histogram.from_dict(result['histogram']))
+
+        if result['pool']:
+            pool = add_pool(pool, dict(result['pool'], connect_times=Histogram.from_dict(result['pool']['connect_times'])))
+
+    total['histogram'] = histogram
+    total['pool'] = pool
+    return total
+
+def add_pool(total, pool):
+    """
+    Add the pool stats pool to total, which is None for the first, and
+    return total.
+    """
+    if total is None:
+        return dict(pool, connect_times=Histogram().merge(pool['connect_times']))
+
+    for key, value in pool.items():
+        if key == 'connect_times':
+            total[key].merge(value)
+        else:
+            total[key] += value
+
+    return total
+
+def combine(trials):
+    """
+    Add up repeated trials of a point like merge() adds up processes. The
+    throughput and latency of each trial are kept as well, for
+    resultstore.compare() to test.
+    """
+    total = {
+        'completed': 0,
+        'failed': 0,
+        'errors': collections.Counter(),
+        'statuses': collections.Counter(),
+        'bytes': 0,
+        'elapsed': 0,
+        'process_rps': [],
+        'histogram': Histogram(),
+        'pool': None,
+        'rates': [],
+        'trial_latency': [],
+    }
+
+    for trial in trials:
+        total['rates'].append(trial['completed'] / trial['elapsed'] if trial['elapsed'] else 0.0)
+        total['trial_latency'].append({'mean': trial['histogram'].mean(), 'p99': trial['histogram'].percentile(99)})
+
+        for key in ('completed', 'failed', 'bytes', 'elapsed'):
+            total[key] += trial[key]
+        total['errors'].update(trial['errors'])
+        total['statuses'].update(trial['statuses'])
+        total['process_rps'] += trial['process_rps']
+        total['histogram'].merge(trial['histogram'])
+
+        if trial['pool']:
+            total['pool'] = add_pool(total['pool'], trial['pool'])
+
+    return total
+
+def bench(name, target, args, point):
+    """
+    Run a benchmark point over args.processes processes sharing one Budget
+    and return the merged results. Each child sends its result back over
+    its own pipe. A single process runs in this one, unless the backend is
+    isolated.
+    """
+    budget = Budget(count=None if args.duration else args.requests, duration=args.duration,
+        rate=point['rate'], batch=args.batch, processes=args.processes)
+
+    if args.processes == 1 and not BACKENDS[name].isolated:
+        result = attempt(name, target, args, point, budget)
+        if 'error' in result:
+            raise BenchmarkError(result['error'])
+
+        return merge([result])
+
+    procs = []
+    for _ in range(args.processes):
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        proc = multiprocessing.Process(target=child, args=(writer, name, target, args, point, budget))
+        proc.start()
+        # Only the child holds the write end now, so recv() fails rather
+        # than blocks if the child dies without sending.
+        writer.close()
+        procs.append((proc, reader))
+
+    results = []
+    errors = []
+    for proc, reader in procs:
+        try:
+            result = reader.recv()
+        except EOFError:
+            proc.join()
+            result = {'error': 'client process exited with code %s without a result' % proc.exitcode}
+
+        if 'error' in result:
+            errors.append(result['error'])
+        else:
+            results.append(result)
+
+        reader.close()
+        proc.join()
+
+    if errors:
+        raise BenchmarkError(errors[0])
+
+    return merge(results)
+
+def points(args):
+    for name in args.backends:
+        backend = BACKENDS[name]
+        loops = [loop for loop in args.loops if loop in backend.loops] or backend.loops[:1]
+
+        for loop in loops:
+            for connections in args.connections:
+                for depth in (args.depths if backend.pipelines else [1]):
+                    for rate in args.rates:
+                        yield name, {'loop': loop, 'connections': connections, 'depth': depth, 'rate': rate}
+
+HEADER = '%-9s %-9s %6s %5s %8s %9s %7s %9s %7s %8s %8s %8s %8s %8s %6s' % (
+    'backend', 'loop', 'conns', 'depth', 'rate', 'requests', 'failed', 'rps', 'MB/s', 'p50 ms', 'p90 ms',
+    'p99 ms', 'p99.9 ms', 'max ms', 'reuse')
+
+def report(name, point, total):
+    summary = total['histogram'].summary()
+    rps = total['completed'] / total['elapsed'] if total['elapsed'] else 0.0
+    throughput = total['bytes'] / total['elapsed'] / 1e6 if total['elapsed'] else 0.0
+
+    reuse = '-'
+    if total['pool'] and total['pool']['requests']:
+        reuse = '%.4f' % (1 - total['pool']['connects'] / total['pool']['requests'])
+
+    print('%-9s %-9s %6d %5d %8s %9d %7d %9.1f %7.2f %8.2f %8.2f %8.2f %8.2f %8.2f %6s' % (
+        name, point['loop'], point['connections'], point['depth'], '%.0f' % point['rate'] if point['rate'] else 'closed',
+        total['completed'], total['failed'], rps, throughput, summary['p50'] / 1e6, summary['p90'] / 1e6, summary['p99'] / 1e6,
+        summary['p99.9'] / 1e6, summary['max'] / 1e6, reuse))
+
+    if len(total['rates']) > 1:
+        print('    %d trials: %.1f +/- %.1f rps (95%% CI)' % ((len(total['rates']),) + confidence_interval(total['rates'])))
+
+    if len(total['process_rps']) > len(total['rates']):
+        print('    per process: %.1f to %.1f rps' % (min(total['process_rps']), max(total['process_rps'])))
+
+    pool = total['pool']
+    if pool and pool['connects']:
+        connect_times = pool['connect_times']
+        print('    connects: %d, mean %.2f ms, p99 %.2f ms; server closes %d, retired %d, connect failures %d' % (
+            pool['connects'], connect_times.mean() / 1e6, connect_times.percentile(99) / 1e6, pool['closed'],
+            pool['retired'], pool['failures']))
+
+    if total['statuses']:
+        print('    not 2xx: %s' % ', '.join('%s %d' % status for status in sorted(total['statuses'].items())))
+
+    if total['errors']:
+        print('    failures: %s' % ', '.join('%s %d' % error for error in sorted(total['errors'].items())))
+
+def record(store, name, args, point, total):
+    store.append({
+        'bench': 'http',
+        'function': name,
+        'mode': '%s, %d connections, depth %d, %s' % (
+            point['loop'], point['connections'], point['depth'], 'rate %g' % point['rate'] if point['rate'] else 'closed loop'),
+        'workers': args.processes,
+        'url': args.url,
+        'method': args.method,
+        'completed': total['completed'],
+        'failed': total['failed'],
+        'bytes': total['bytes'],
+        'elapsed': total['elapsed'],
+        'throughput': total['completed'] / total['elapsed'] if total['elapsed'] else 0.0,
+        'rates': total['rates'],
+        'trial_latency': total['trial_latency'],
+        'histogram': total['histogram'].to_dict(),
+        'pool': dict(total['pool'], connect_times=total['pool']['connect_times'].to_dict()) if total['pool'] else None,
+    })
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+def float_list(value):
+    return [float(item) for item in value.split(',')]
+
+def name_list(value):
+    return value.split(',')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark HTTP client backends against a server.')
+    parser.add_argument('url', nargs='?', help='URL to request (default: start a local httpserver.py)')
+    parser.add_argument('-m', '--method', default='HEAD', help='request method (default: %(default)s)')
+    parser.add_argument('-H', '--header', action='append', default=[], dest='headers',
+        help='extra request header, "Name: value", may be repeated')
+    parser.add_argument('--id-header', help='header to number each request with, e.g. X-Request-Id')
+    parser.add_argument('-b', '--backends', type=name_list, default=['streams'],
+        help='comma separated backends from %s (default: streams)' % ', '.join(sorted(BACKENDS)))
+    parser.add_argument('-l', '--loops', type=name_list, default=['asyncio'],
+        help='comma separated event loops (asyncio, uvloop) for the backends that take one (default: asyncio)')
+    parser.add_argument('-c', '--concurrency', type=int, default=1000,
+        help='closed loop workers per process (default: %(default)s)')
+    parser.add_argument('--connections', type=int_list, default=[10],
+        help='comma separated connection limits per process (default: 10)')
+    parser.add_argument('--depths', type=int_list, default=[1],
+        help='comma separated pipeline depths for the protocol backend (default: 1)')
+    parser.add_argument('--rates', type=float_list, default=[0],
+        help='comma separated total request rates for an open loop, 0 is a closed loop (default: 0)')
+    parser.add_argument('-n', '--requests', type=int, default=100000, help='total requests (default: %(default)s)')
+    parser.add_argument('-d', '--duration', type=float, help='run each benchmark for this many seconds instead')
+    parser.add_argument('-p', '--processes', type=int, default=int(os.getenv('GOMAXPROCS', multiprocessing.cpu_count() * 2)),
+        help='client processes (default: $GOMAXPROCS or twice the CPU count)')
+    parser.add_argument('-t', '--trials', type=int, default=3,
+        help='times to run each benchmark, so resultstore.py can test changes for significance (default: %(default)s)')
+    parser.add_argument('--batch', type=int, default=100,
+        help='requests a process claims from the shared budget at a time (default: %(default)s)')
+    parser.add_argument('--max-requests', type=int, default=0, help='retire connections after this many requests')
+    parser.add_argument('--idle-ttl', type=float, default=0, help='retire connections idle for this many seconds')
+    parser.add_argument('--results', help='append a JSONL record per benchmark, see resultstore.py')
+    parser.add_argument('--run', help='run id for --results (default: a timestamp)')
+
+    server_options = parser.add_argument_group('local server', 'Used when no URL is given, see httpserver.py.')
+    server_options.add_argument('--server-processes', type=int, default=multiprocessing.cpu_count(),
+        help='server worker processes (default: the CPU count)')
+    server_options.add_argument('--server-loop', default='asyncio', choices=('asyncio', 'uvloop'),
+        help='server event loop (default: %(default)s)')
+    server_options.add_argument('--seed', type=int, help='seed for the server\'s latency and errors')
+    httpserver.add_arguments(server_options)
+    args = parser.parse_args(argv)
+
+    for name in args.backends:
+        if name not in BACKENDS:
+            parser.error('unknown backend %r, choose from %s' % (name, ', '.join(sorted(BACKENDS))))
+
+    headers = []
+    for header in args.headers:
+        name, colon, value = header.partition(':')
+        if not colon:
+            parser.error('invalid header %r, expected "Name: value"' % header)
+        headers.append((name.strip(), value.strip()))
+
+    server = None
+    if not args.url:
+        try:
+            server = httpserver.Server(processes=args.server_processes, loop=args.server_loop, seed=args.seed,
+                **httpserver.behaviour_options(args))
+        except ValueError as e:
+            parser.error(str(e))
+
+        server.start()
+        args.url = server.url
+        print('Started a local server on %s with %d processes.' % (server.url, args.server_processes))
+
+    try:
+        try:
+            target = Target(args.url, args.method, headers, args.id_header)
+        except ValueError as e:
+            parser.error(str(e))
+
+        return sweep(args, target)
+    finally:
+        if server:
+            server.stop()
+
+def sweep(args, target):
+    """
+    Benchmark every point of the sweep and print the table, return 1 if any
+    failed.
+    """
+    store = ResultStore(args.results, args.run) if args.results else None
+
+    print('%s %s, %d processes, %d trials of %s' % (args.method, args.url, args.processes, args.trials,
+        '%g seconds' % args.duration if args.duration else '%d requests' % args.requests))
+    print(HEADER)
+
+    failures = 0
+    for name, point in points(args):
+        try:
+            total = combine([bench(name, target, args, point) for _ in range(args.trials)])
+        except BenchmarkError as e:
+            # Usually a backend whose library isn't installed, carry on
+            # with the rest of the sweep.
+            failures += 1
+            print('%-9s %-9s failed: %s' % (name, point['loop'], str(e).strip().splitlines()[-1]))
+            continue
+
+        report(name, point, total)
+
+        if store:
+            record(store, name, args, point, total)
+
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import sys
+import time
+from histogram import Histogram
+from stats import mean_variance, welch_significant
+
+def usage():
+    """
+    Return the CPU seconds and peak RSS (KB) used by this process and the
+    children it has reaped.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    cpu_time = own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+    return cpu_time, max(own.ru_maxrss, children.ru_maxrss)
+
+def host():
+    return {
+        'hostname': socket.gethostname(),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'cpus': multiprocessing.cpu_count(),
+    }
+
+class ResultStore:
+    """
+    Append-only JSONL file of benchmark records. Every record written by one
+    ResultStore shares a run id so that runs can be compared later.
+    """
+    def __init__(self, path, run=None):
+        self.path = path
+        self.run = run or time.strftime('%Y%m%dT%H%M%S')
+        self.host = host()
+
+    def append(self, record):
+        record = dict(record, run=self.run, timestamp=time.time(), host=self.host)
+
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return []
+
+        with open(self.path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+
+    def runs(self):
+        runs = []
+
+        for record in self.load():
+            if record['run'] not in runs:
+                runs.append(record['run'])
+
+        return runs
+
+def bench_key(record):
+    return (record['bench'], record['function'], record['mode'], record['workers'])
+
+def samples(record, metric):
+    """
+    Return the per-trial samples of metric in record, or a single value for
+    records from a single trial.
+    """
+    trial_latency = record.get('trial_latency') or []
+
+    if metric == 'calls/s':
+        return record.get('rates') or [record['throughput']]
+
+    if metric == 'mean latency (ns)':
+        return [trial['mean'] for trial in trial_latency] or [Histogram.from_dict(record['histogram']).mean()]
+
+    return [trial['p99'] for trial in trial_latency] or [Histogram.from_dict(record['histogram']).percentile(99)]
+
+def compare(old_records, new_records, threshold=0.05):
+    """
+    Compare the benchmarks present in both sets of records. Return a list of
+    (key, metric, old, new, change, regression) rows.
+
+    Throughput, mean latency and p99 latency are compared across trials: a
+    change for the worse is a regression when it is larger than threshold
+    and Welch's t-test on the per-trial values says it is significant.
+    Records with a single trial (loadgen.py --trials 1) can't be tested,
+    their regression is None. The calls within a trial aren't independent, so
+    they are never used as samples.
+    """
+    old = dict((bench_key(record), record) for record in old_records)
+    rows = []
+
+    for record in new_records:
+        key = bench_key(record)
+        if key not in old:
+            continue
+
+        for metric in ('calls/s', 'mean latency (ns)', 'p99 latency (ns)'):
+            old_samples = samples(old[key], metric)
+            new_samples = samples(record, metric)
+            old_mean, old_variance = mean_variance(old_samples)
+            new_mean, new_variance = mean_variance(new_samples)
+
+            change = (new_mean - old_mean) / old_mean if old_mean else 0.0
+            worse = change < -threshold if metric == 'calls/s' else change > threshold
+
+            regression = None
+            if len(old_samples) > 1 and len(new_samples) > 1:
+                regression = worse and welch_significant(
+                    old_mean, old_variance, len(old_samples), new_mean, new_variance, len(new_samples))
+
+            rows.append((key, metric, old_mean, new_mean, change, regression))
+
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two bencher runs.')
+    parser.add_argument('path', help='JSONL result file')
+    parser.add_argument('--old', help='baseline run id (default: second to last run)')
+    parser.add_argument('--new', help='candidate run id (default: last run)')
+    parser.add_argument('--threshold', type=float, default=0.05, help='minimum relative change to flag')
+    args = parser.parse_args(argv)
+
+    store = ResultStore(args.path)
+    runs = store.runs()
+
+    old_run = args.old or (runs[-2] if len(runs) > 1 else None)
+    new_run = args.new or (runs[-1] if runs else None)
+    if not old_run or not new_run:
+        parser.error('need two runs to compare, found %d' % len(runs))
+
+    records = store.load()
+    rows = compare(
+        [record for record in records if record['run'] == old_run],
+        [record for record in records if record['run'] == new_run],
+        args.threshold)
+
+    print('Comparing run %s to %s' % (old_run, new_run))
+
+    regressions = 0
+    for (kind, function, mode, workers), metric, old, new, change, regression in rows:
+        regressions += bool(regression)
+        print('%-10s %s %s [%s, %d workers] %s: %.2f -> %.2f (%+.1f%%)' % (
+            'not tested' if regression is None else 'REG' if regression else 'ok', kind, function, mode, workers, metric, old, new, change * 100))
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+# Two-sided 95% critical values of Student's t distribution, by degrees of
+# freedom. Anything past the table uses the normal approximation.
+T_95 = [
+    None, 12.706, 4.303, 3.182, 2.776, 2.571, 2.447, 2.365, 2.306, 2.262,
+    2.228, 2.201, 2.179, 2.160, 2.145, 2.131, 2.120, 2.110, 2.101, 2.093,
+    2.086, 2.080, 2.074, 2.069, 2.064, 2.060, 2.056, 2.052, 2.048, 2.045,
+    2.042,
+]
+
+def t_critical(df):
+    df = int(df)
+
+    if df < 1:
+        return float('inf')
+    if df < len(T_95):
+        return T_95[df]
+
+    return 1.96
+
+def mean_variance(samples):
+    n = len(samples)
+    mean = sum(samples) / n
+
+    if n < 2:
+        return mean, 0.0
+
+    return mean, sum((sample - mean) ** 2 for sample in samples) / (n - 1)
+
+def confidence_interval(samples):
+    """
+    Return the mean of samples and the half width of its 95% confidence
+    interval.
+    """
+    n = len(samples)
+    mean, variance = mean_variance(samples)
+
+    if n < 2:
+        return mean, float('inf')
+
+    return mean, t_critical(n - 1) * (variance / n) ** 0.5
+
+def welch_significant(mean1, variance1, n1, mean2, variance2, n2):
+    """
+    Welch's t-test: return True if the two means differ at the 95% level.
+    """
+    if n1 < 2 or n2 < 2:
+        return False
+
+    error1 = variance1 / n1
+    error2 = variance2 / n2
+
+    if not error1 and not error2:
+        return mean1 != mean2
+
+    t = abs(mean1 - mean2) / (error1 + error2) ** 0.5
+    df = (error1 + error2) ** 2 / (error1 ** 2 / (n1 - 1) + error2 ** 2 / (n2 - 1))
+    return t > t_critical(df)
@@ -1,7 +1,10 @@
 #!/usr/bin/python2
 import coroutine
+import httpparser
 import socket
 import hashlib
+import time
+import multiprocessing
 
 def test_coroutine(arg=None):
     print 'in coroutine: %s' % arg
@@ -100,6 +103,85 @@ def test_server():
     yield coroutine.ScheduleTask(launch_clients(port, 15))
     yield coroutine.ScheduleTask(accept_clients(server, 15))
 
+def test_sleep(seconds):
+    start = time.time()
+
+    print 'Sleeping for %.2f seconds' % seconds
+    yield coroutine.Sleep(seconds)
+
+    elapsed = time.time() - start
+    print 'Slept for %.2f seconds (expected: %.2f)' % (elapsed, seconds)
+    assert elapsed >= seconds
+
+def event_setter(event, seconds):
+    yield coroutine.Sleep(seconds)
+    print 'Setting event'
+    event.set()
+
+def test_event():
+    event = coroutine.Event()
+    yield coroutine.ScheduleTask(event_setter(event, 0.05))
+
+    yield event
+    print 'Event was set (expected: True): %s' % event.is_set()
+    assert event.is_set()
+
+def test_recv_timeout():
+    server = coroutine.Socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+
+    addr, port = server.getsockname()
+
+    client = coroutine.Socket()
+    yield client.connect(('127.0.0.1', port), timeout=1)
+
+    # The server never accepts or sends, so the read has to time out.
+    try:
+        yield client.recv(4096, timeout=0.1)
+        assert False, 'recv did not time out'
+    except coroutine.Timeout as e:
+        print 'recv timed out: %s' % e
+
+    yield client.close()
+    yield server.close()
+
+def test_buffered_client(port, lines, payload):
+    client = coroutine.Socket()
+    yield client.connect(('127.0.0.1', port))
+
+    yield client.send(''.join(lines) + payload)
+    yield client.close()
+
+def test_buffered_reads():
+    server = coroutine.Socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(5)
+
+    addr, port = server.getsockname()
+
+    lines = ['hello\n', 'world\n']
+    payload = 'x' * 200000
+    yield coroutine.ScheduleTask(test_buffered_client(port, lines, payload))
+
+    addr, client = yield server.accept()
+    client.buffer_size = 1024
+
+    for expected in lines:
+        line = yield client.readline()
+        print 'Read line %r (expected: %r)' % (line, expected)
+        assert line == expected
+
+    data = yield client.readexactly(len(payload))
+    print 'Read %d bytes (expected: %d)' % (len(data), len(payload))
+    assert data == payload
+
+    rest = yield client.readline()
+    assert rest == ''
+
+    yield client.close()
+    yield server.close()
+
 generator2_exited = False
 
 def generator2(iterations):
@@ -134,7 +216,179 @@ def rude_generator():
     print 'end busy loop!'
     yield value
 
+def trivial_generator():
+    return
+    yield
+
+def bench_context_switches(num_generators):
+    coroutines = coroutine.Scheduler()
+
+    for _ in range(num_generators):
+        coroutines.add_coroutine(trivial_generator())
+
+    start = time.time()
+    coroutines.run_until_complete()
+    total = time.time() - start
+    coroutines.close()
+
+    print '%d context switches in %.2f seconds, %.0f switches/s' % (num_generators, total, num_generators / total)
+
+def echo_handler(client, addr):
+    received = yield client.recv(4096)
+    yield client.send(received)
+    yield client.close()
+
+def hammer(address, duration):
+    end = time.time() + duration
+
+    while time.time() < end:
+        try:
+            client = socket.create_connection(address, timeout=1)
+            client.sendall('ping')
+            client.recv(4096)
+            client.close()
+        except socket.error:
+            pass
+
+def bench_accept_scaling(max_processes, duration=2):
+    for processes in range(1, max_processes + 1):
+        server = coroutine.ShardedServer(('127.0.0.1', 0), echo_handler, processes)
+        server.start(duration)
+
+        clients = [multiprocessing.Process(target=hammer, args=(server.address, duration)) for _ in range(processes * 2)]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+
+        stats = server.join()
+        print '%d processes: %d connections in %.2f seconds, %.0f accepts/s (per process: %s)' % (
+            processes, stats['accepted'], stats['elapsed'], stats['rate'],
+            [worker['accepted'] for worker in stats['workers']])
+
+def parse(data, size, head=False, eof=False):
+    """
+    Feed data to a ResponseParser size bytes at a time and return every
+    response it completes.
+    """
+    parser = httpparser.ResponseParser()
+    responses = []
+
+    for offset in range(0, len(data), size):
+        parser.feed(data[offset:offset + size])
+
+        while True:
+            response = parser.next(head=head)
+            if response is None:
+                break
+            responses.append(response)
+
+    if eof:
+        response = parser.eof()
+        if response is not None:
+            responses.append(response)
+
+    return responses
+
+def test_parser_content_length():
+    data = (b'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello'
+            b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nX-Thing: a\r\n\r\n')
+
+    for size in range(1, len(data) + 1):
+        responses = parse(data, size)
+        assert [response.status for response in responses] == [200, 404]
+        assert responses[0].body == b'hello'
+        assert responses[1].body == b''
+        assert responses[1].header(b'X-Thing') == b'a'
+
+    print 'parser content-length ok'
+
+def test_parser_chunked():
+    data = (b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+            b'5;name=value\r\nhello\r\n6\r\n world\r\n0\r\nX-Trailer: yes\r\n\r\n'
+            b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n0\r\n\r\n')
+
+    for size in range(1, len(data) + 1):
+        responses = parse(data, size)
+        assert len(responses) == 2
+        assert responses[0].body == b'hello world'
+        assert responses[1].body == b''
+
+    print 'parser chunked ok'
+
+def test_parser_until_close():
+    data = b'HTTP/1.0 200 OK\r\nServer: test\r\n\r\nbody until close'
+
+    for size in range(1, len(data) + 1):
+        responses = parse(data, size, eof=True)
+        assert len(responses) == 1
+        assert responses[0].body == b'body until close'
+
+    # Closed half way through a Content-Length body.
+    try:
+        parse(b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\nshort', 4, eof=True)
+    except httpparser.ParseError:
+        pass
+    else:
+        assert False, 'truncated body should not parse'
+
+    print 'parser until close ok'
+
+def test_parser_no_body():
+    head = b'HTTP/1.1 200 OK\r\nContent-Length: 10\r\n\r\n' * 2
+    empty = (b'HTTP/1.1 204 No Content\r\nContent-Length: 10\r\n\r\n'
+             b'HTTP/1.1 304 Not Modified\r\nTransfer-Encoding: chunked\r\n\r\n'
+             b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+
+    for size in range(1, len(empty) + 1):
+        responses = parse(head, size, head=True)
+        assert [response.body_length for response in responses] == [0, 0]
+
+        responses = parse(empty, size)
+        assert [response.status for response in responses] == [204, 304, 200]
+        assert [response.body for response in responses] == [b'', b'', b'ok']
+
+    print 'parser HEAD, 204 and 304 ok'
+
+def test_parser_interim():
+    data = (b'HTTP/1.1 100 Continue\r\n\r\n'
+            b'HTTP/1.1 103 Early Hints\r\nLink: </style.css>; rel=preload\r\n\r\n'
+            b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok'
+            b'HTTP/1.1 204 No Content\r\n\r\n'
+            b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n\r\n')
+
+    for size in range(1, len(data) + 1):
+        responses = parse(data, size)
+        assert [response.status for response in responses] == [200, 204, 101]
+        assert responses[0].body == b'ok'
+        assert sum(response.size for response in responses) == len(data)
+
+    print 'parser interim responses ok'
+
+def test_parser_size():
+    # Big enough that the buffer is compacted part way through.
+    data = (b'HTTP/1.1 200 OK\r\nContent-Length: 70000\r\n\r\n' + b'x' * 70000 +
+            b'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n0\r\n\r\n') * 3
+
+    for size in (1000, 4096, 65536, len(data)):
+        responses = parse(data, size)
+        assert len(responses) == 6
+        assert [response.body_length for response in responses] == [70000, 3] * 3
+        assert sum(response.size for response in responses) == len(data)
+
+    print 'parser size ok'
+
 if __name__ == '__main__':
+    test_parser_content_length()
+    test_parser_chunked()
+    test_parser_until_close()
+    test_parser_no_body()
+    test_parser_interim()
+    test_parser_size()
+
+    bench_context_switches(100000)
+    bench_accept_scaling(multiprocessing.cpu_count())
+
     google = socket.gethostbyname('google.com')
 
     coroutines = coroutine.Scheduler(timeout=0.001)
@@ -150,5 +404,15 @@ if __name__ == '__main__':
     coroutines.add_coroutine(test())
     coroutines.add_coroutine(test_server())
     coroutines.add_coroutine(generator1(100))
+    coroutines.add_coroutine(test_sleep(0.1))
+    coroutines.add_coroutine(test_recv_timeout())
+    coroutines.add_coroutine(test_event())
+    coroutines.add_coroutine(test_buffered_reads())
     coroutines.add_coroutine(rude_generator())
     coroutines.run_until_complete()
+
+    long_steps = [step['name'] for step in coroutines.long_steps]
+    print 'Long running steps: %s' % long_steps
+    assert 'rude_generator' in long_steps
+
+    coroutines.close()
@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+"""
+Python 3 tests for coroutine.Scheduler driving async def coroutines and for
+coroutine_asyncio. test_coroutine.py covers the Python 2 paths.
+"""
+import errno
+import socket
+import coroutine
+import coroutine_asyncio as aio
+
+def run(coro):
+    loop = aio.new_event_loop()
+
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+async def add(a, b):
+    await coroutine.Sleep(0)
+    return a + b
+
+def test_async_def():
+    events = []
+    event = coroutine.Event()
+
+    async def waiter():
+        await event
+        events.append('woken')
+
+    async def setter():
+        await coroutine.Sleep(0.01)
+        events.append('set')
+        event.set()
+
+    scheduler = coroutine.Scheduler()
+    scheduler.add_coroutine(waiter())
+    scheduler.add_coroutine(setter())
+    scheduler.run_until_complete()
+    scheduler.close()
+
+    assert events == ['set', 'woken'], events
+    print('async def ok')
+
+def test_return_values():
+    results = []
+
+    def child():
+        yield coroutine.Sleep(0)
+        return 'generator'
+
+    def parent():
+        # A native coroutine and a generator yielded as children, both
+        # returning through StopIteration.value.
+        results.append((yield add(1, 2)))
+        results.append((yield child()))
+
+    scheduler = coroutine.Scheduler()
+    scheduler.add_coroutine(parent())
+    scheduler.run_until_complete()
+    scheduler.close()
+
+    assert results == [3, 'generator'], results
+    print('return values ok')
+
+def test_future_task():
+    async def fail():
+        await coroutine.Sleep(0)
+        raise ValueError('boom')
+
+    async def main():
+        loop = aio.get_event_loop()
+        future = loop.create_future()
+        done = []
+        future.add_done_callback(lambda f: done.append(f.result()))
+
+        async def resolve():
+            await aio.sleep(0.01)
+            future.set_result('resolved')
+
+        loop.create_task(resolve())
+        assert await future == 'resolved'
+        assert done == ['resolved']
+
+        assert await aio.ensure_future(add(2, 3)) == 5
+
+        task = aio.ensure_future(fail())
+        try:
+            await task
+        except ValueError as e:
+            assert str(e) == 'boom'
+        else:
+            assert False, 'task should have raised'
+
+        return 'main'
+
+    assert run(main()) == 'main'
+    print('future and task ok')
+
+def test_lock_semaphore():
+    lock = aio.Lock()
+    semaphore = aio.Semaphore(2)
+    state = {'locked': 0, 'in_semaphore': 0, 'most': 0}
+
+    async def locked():
+        async with lock:
+            state['locked'] += 1
+            assert state['locked'] == 1
+            await aio.sleep(0.001)
+            state['locked'] -= 1
+
+    async def bounded():
+        async with semaphore:
+            state['in_semaphore'] += 1
+            state['most'] = max(state['most'], state['in_semaphore'])
+            await aio.sleep(0.001)
+            state['in_semaphore'] -= 1
+
+    async def main():
+        await aio.wait([locked() for _ in range(5)] + [bounded() for _ in range(5)])
+
+    run(main())
+    assert not lock.locked()
+    assert state['most'] == 2, state
+    print('lock and semaphore ok')
+
+def test_wait():
+    async def main():
+        fast = aio.ensure_future(aio.sleep(0.001, 'fast'))
+        slow = aio.ensure_future(aio.sleep(0.05, 'slow'))
+
+        done, pending = await aio.wait([fast, slow], return_when=aio.FIRST_COMPLETED)
+        assert done == set([fast]) and pending == set([slow])
+
+        done, pending = await aio.wait([fast, slow])
+        assert done == set([fast, slow]) and not pending
+        assert slow.result() == 'slow'
+
+    run(main())
+    print('wait ok')
+
+def test_streams():
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    port = listener.getsockname()[1]
+
+    # More than the socket buffers hold, so write() leaves the rest to the
+    # flusher while the other end reads.
+    data = bytes(range(256)) * 16384
+
+    async def main():
+        reader, writer = await aio.open_connection('127.0.0.1', port)
+        server, _ = listener.accept()
+        server.setblocking(False)
+        server_reader = aio.StreamReader(server)
+
+        writer.write(data)
+        assert not writer.flushed.is_set(), 'write() should have left data to the flusher'
+
+        received = bytearray()
+        while len(received) < len(data):
+            received += await server_reader.read(65536)
+
+        await writer.drain()
+        assert bytes(received) == data
+
+        writer.close()
+        assert await server_reader.read() == b''
+        assert server_reader.at_eof()
+        server.close()
+
+    run(main())
+    listener.close()
+    print('streams ok')
+
+def test_connect_refused():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    async def main():
+        try:
+            await aio.open_connection('127.0.0.1', port)
+        except OSError as e:
+            assert e.errno == errno.ECONNREFUSED, e
+        else:
+            assert False, 'connect to a closed port should fail'
+
+    run(main())
+    print('connect refused ok')
+
+def test_socket_connect_refused():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    errors = []
+
+    def connect():
+        client = coroutine.Socket()
+        try:
+            yield client.connect(('127.0.0.1', port))
+        except OSError as e:
+            errors.append(e.errno)
+        client.close()
+
+    scheduler = coroutine.Scheduler()
+    scheduler.add_coroutine(connect())
+    scheduler.run_until_complete()
+    scheduler.close()
+
+    assert errors == [errno.ECONNREFUSED], errors
+    print('socket connect refused ok')
+
+def test_stats():
+    def noop():
+        yield coroutine.Sleep(0)
+
+    scheduler = coroutine.Scheduler()
+    try:
+        scheduler.sample_stats(1, print)
+    except ValueError:
+        pass
+    else:
+        assert False, 'sample_stats() needs stats=True'
+    scheduler.close()
+
+    scheduler = coroutine.Scheduler(stats=True)
+    for _ in range(3):
+        scheduler.submit(noop())
+    scheduler.run_until_complete()
+    scheduler.close()
+
+    assert scheduler.stats.queue_max == 3, scheduler.stats.queue_max
+    print('stats ok')
+
+if __name__ == '__main__':
+    test_async_def()
+    test_return_values()
+    test_future_task()
+    test_lock_semaphore()
+    test_wait()
+    test_streams()
+    test_connect_refused()
+    test_socket_connect_refused()
+    test_stats()